@@ -24,9 +24,17 @@ from typing import (
 from .version import __version__
 
 from .consts import ALPHANUMERIC_CHARS, ALPHANUMERIC_EXT_CHARS
-from .crypto import is_jwt
-from .env import typed_evar
-from .exceptions import NotPrintableError
+from .crypto import (
+    digest_many,
+    file_digest,
+    is_jwt,
+    is_jwt_many,
+    jwt_decode,
+    jwt_encode,
+    JWTCache,
+)
+from .env import EnvSettings, EnvVar, load_dotenv, typed_evar
+from .exceptions import ExpiredJWTError, InvalidJWTError, NotPrintableError
 from .python import (
     default_repr,
     ranstr,
@@ -38,6 +46,24 @@ from .python import (
     UniqueList,
     UniqueList as UList,
 )
-from .shell import runcmd
-from .terminal import get_terminal_width, print_columns, print_middle
+from .shell import (
+    aruncmd,
+    CommandCache,
+    pipeline,
+    runcmd,
+    runcmd_many,
+    runcmd_stream,
+    ShellPool,
+    ShellSession,
+    UsageReport,
+)
+from .terminal import (
+    get_terminal_width,
+    print_columns,
+    print_middle,
+    print_table,
+    Progress,
+    TerminalContext,
+    TerminalWriter,
+)
 from .test import RanData
@@ -1,7 +1,36 @@
 import base64 as b64
-from typing import Union
+import hashlib
+import hmac
+import mmap
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 import json
 
+from .exceptions import ExpiredJWTError, InvalidJWTError
+
+# three base64url segments, padding is tolerated though JWTs omit it
+_SEGMENT = r'([A-Za-z0-9_-]+={0,2})'
+_SEGMENTS = r'\.'.join([_SEGMENT] * 3)
+_JWT_STR_RE = re.compile(_SEGMENTS)
+_JWT_BYTES_RE = re.compile(_SEGMENTS.encode('ascii'))
+# base64url of '{"', the start of every compact JSON header
+_HEADER_PREFIX = 'eyJ'
+
 
 def _pad(s: str) -> str:
     """
@@ -15,26 +44,53 @@ def _pad(s: str) -> str:
     return s if padding == 0 else s + '=' * (4 - padding)
 
 
-def is_jwt(s: Union[str, bytes]) -> bool:
+def _is_json_segment(segment: str) -> bool:
+    """
+    Check if a base64url segment decodes to JSON.
+    Args:
+        segment (str): The base64url encoded segment.
+    Returns:
+        bool: True if the segment is base64url encoded JSON.
+    """
+    try:
+        json.loads(b64.urlsafe_b64decode(_pad(segment)).decode('utf-8'))
+        return True
+    except Exception:
+        return False
+
+
+# tokens mostly share a handful of headers, so cache their validation
+_is_json_header = lru_cache(maxsize=1024)(_is_json_segment)
+
+
+def is_jwt(s: Union[str, bytes], strict: bool = False) -> bool:
     """
     Check if a string is a valid JWT (JSON Web Token).
+    By default only the structure is checked: three base64url segments,
+    a header starting with 'eyJ' which decodes to JSON, a payload of a
+    valid base64 length and a signature of at least 10 characters.
     Args:
         s (Union[str, bytes]): Input suspected JWT bytes or string.
+        strict (bool): Also require the payload to decode to JSON, and
+            allow headers not starting with 'eyJ'. Defaults to False.
     Returns:
         bool: True if the input is a valid JWT, False otherwise.
     """
     try:
-        if isinstance(s, bytes):
-            s = s.decode('utf-8')
-
-        segments = s.split('.')
-        if len(segments) != 3:
+        if s.count('.' if isinstance(s, str) else b'.') != 2:
             return False
-
-        # Decoding header and payload to check if they are valid JSON
-        header, payload, signature = segments
-        json.loads(b64.urlsafe_b64decode(_pad(header)).decode('utf-8'))
-        json.loads(b64.urlsafe_b64decode(_pad(payload)).decode('utf-8'))
+        if isinstance(s, str):
+            match = _JWT_STR_RE.fullmatch(s)
+            if match is None:
+                return False
+            header, payload, signature = match.groups()
+        else:
+            match = _JWT_BYTES_RE.fullmatch(s)
+            if match is None:
+                return False
+            header, payload, signature = (
+                g.decode('ascii') for g in match.groups()
+            )
 
         # Rudimentary check for signature length
         if (
@@ -42,6 +98,474 @@ def is_jwt(s: Union[str, bytes]) -> bool:
         ):  # Minimum length for a JWT signature is typically more than 10 characters
             return False
 
-        return True
+        if strict:
+            return _is_json_header(header) and _is_json_segment(payload)
+
+        # one base64 char in the last quantum can never be decoded
+        if len(payload.rstrip('=')) % 4 == 1:
+            return False
+        return header.startswith(_HEADER_PREFIX) and _is_json_header(header)
     except Exception:
         return False
+
+
+def is_jwt_many(
+    tokens: Iterable[Union[str, bytes]], strict: bool = False
+) -> List[bool]:
+    """
+    Check many suspected JWTs, see is_jwt().
+    Args:
+        tokens (Iterable[Union[str, bytes]]): Input suspected JWTs.
+        strict (bool): Passed to is_jwt(). Defaults to False.
+    Returns:
+        List[bool]: is_jwt() result for each token, in order.
+    """
+    _is_jwt = is_jwt
+    return [_is_jwt(token, strict) for token in tokens]
+
+
+_HMAC_ALGORITHMS = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
+}
+
+
+def _b64encode(data: bytes) -> bytes:
+    return b64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(segment: bytes) -> bytes:
+    data = b64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4))
+    # urlsafe_b64decode drops unknown characters and ignores the unused
+    # low bits, only accept the canonical encoding so a token has exactly
+    # one valid spelling
+    if _b64encode(data) != segment:
+        raise ValueError('Non canonical base64url segment')
+    return data
+
+
+def _to_bytes(s: Union[str, bytes]) -> bytes:
+    return s.encode('utf-8') if isinstance(s, str) else bytes(s)
+
+
+def jwt_encode(
+    payload: Dict[str, Any], key: Union[str, bytes], algorithm: str = 'HS256'
+) -> str:
+    """
+    Encode and sign a payload as an HMAC (HS256/384/512) JWT.
+    Args:
+        payload (Dict[str, Any]): The JSON serializable claims.
+        key (Union[str, bytes]): The HMAC secret.
+        algorithm (str): One of HS256, HS384, HS512. Defaults to HS256.
+    Returns:
+        str: The compact JWT.
+    """
+    if algorithm not in _HMAC_ALGORITHMS:
+        raise ValueError('Unsupported algorithm: %s' % algorithm)
+    header = {'alg': algorithm, 'typ': 'JWT'}
+    signing_input = b'.'.join(
+        _b64encode(json.dumps(part, separators=(',', ':')).encode('utf-8'))
+        for part in (header, payload)
+    )
+    signature = hmac.new(
+        _to_bytes(key), signing_input, _HMAC_ALGORITHMS[algorithm]
+    ).digest()
+    return (signing_input + b'.' + _b64encode(signature)).decode('ascii')
+
+
+class JWTCache:
+    """
+    LRU cache of verified JWT payloads keyed by a digest of the token and
+    key. Entries are never returned past the token's 'exp' and are
+    dropped when found expired, so repeated requests with the same token
+    skip signature verification. The payload is kept as its JSON and
+    parsed on every hit, callers never share a mutable payload.
+    Args:
+        maxsize (int): Maximum number of cached tokens. Defaults to 4096.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(token: bytes, key: bytes) -> bytes:
+        """
+        Digest identifying a (token, key) pair.
+        Args:
+            token (bytes): The compact JWT.
+            key (bytes): The HMAC secret.
+        Returns:
+            bytes: The cache key.
+        """
+        return hashlib.sha256(
+            hashlib.sha256(key).digest() + b'.' + token
+        ).digest()
+
+    def get(self, ckey: bytes) -> Optional[Tuple[str, bytes, Any]]:
+        """
+        Look up a cached (algorithm, payload JSON, exp) entry.
+        Args:
+            ckey (bytes): Key from cache_key().
+        Returns:
+            Optional[Tuple[str, bytes, Any]]: The entry, None if missing.
+        """
+        with self._lock:
+            entry = self._entries.get(ckey)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ckey)
+            self.hits += 1
+            return entry
+
+    def set(self, ckey: bytes, entry: Tuple[str, bytes, Any]) -> None:
+        with self._lock:
+            self._entries[ckey] = entry
+            self._entries.move_to_end(ckey)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, ckey: bytes) -> None:
+        with self._lock:
+            self._entries.pop(ckey, None)
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """
+        Drop every expired entry.
+        Args:
+            now (Optional[float]): Current unix time. Defaults to time().
+        Returns:
+            int: The number of dropped entries.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [
+                k
+                for k, (_, _, exp) in self._entries.items()
+                if exp is not None and now >= exp
+            ]
+            for k in expired:
+                del self._entries[k]
+        return len(expired)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_jwt_cache = JWTCache()
+
+
+def _check_time_claims(
+    payload: Dict, now: float, leeway: float, verify_exp: bool
+) -> None:
+    exp = payload.get('exp')
+    if verify_exp and exp is not None:
+        if not isinstance(exp, (int, float)) or isinstance(exp, bool):
+            raise InvalidJWTError("'exp' claim must be a number")
+        if now >= exp + leeway:
+            raise ExpiredJWTError('Token expired')
+    nbf = payload.get('nbf')
+    if nbf is not None:
+        if not isinstance(nbf, (int, float)) or isinstance(nbf, bool):
+            raise InvalidJWTError("'nbf' claim must be a number")
+        if now + leeway < nbf:
+            raise InvalidJWTError('Token not yet valid')
+
+
+def jwt_decode(
+    token: Union[str, bytes],
+    key: Union[str, bytes],
+    algorithms: Iterable[str] = ('HS256', 'HS384', 'HS512'),
+    leeway: float = 0,
+    verify_exp: bool = True,
+    cache: Union[JWTCache, bool] = True,
+) -> Dict[str, Any]:
+    """
+    Verify an HMAC (HS256/384/512) JWT and return its payload, checking
+    the 'exp' and 'nbf' claims. Verified tokens are cached (see JWTCache)
+    until their expiry, a cache hit only re-checks the time claims.
+    Args:
+        token (Union[str, bytes]): The compact JWT.
+        key (Union[str, bytes]): The HMAC secret.
+        algorithms (Iterable[str]): Accepted 'alg' header values.
+        leeway (float): Seconds of clock skew allowed for exp/nbf.
+        verify_exp (bool): Reject tokens past 'exp'. Defaults to True.
+        cache (Union[JWTCache, bool]): Cache to use, True for the shared
+            module cache, False to always verify. Defaults to True.
+    Returns:
+        Dict[str, Any]: The verified payload, a new object on every call.
+    Raises:
+        ExpiredJWTError: The token is past its 'exp' claim.
+        InvalidJWTError: The token is malformed or fails verification.
+    """
+    if cache is True:
+        cache = _jwt_cache
+    elif cache is False:
+        cache = None
+    token = _to_bytes(token)
+    key = _to_bytes(key)
+    now = time.time()
+
+    ckey = None
+    if cache is not None:
+        ckey = cache.cache_key(token, key)
+        entry = cache.get(ckey)
+        if entry is not None:
+            alg, raw, exp = entry
+            if alg not in algorithms:
+                raise InvalidJWTError('Algorithm not allowed: %s' % alg)
+            # parsed per hit, callers never share (and mutate) one payload
+            payload = json.loads(raw)
+            try:
+                _check_time_claims(payload, now, leeway, verify_exp)
+            except ExpiredJWTError:
+                cache.discard(ckey)
+                raise
+            return payload
+
+    segments = token.split(b'.')
+    if len(segments) != 3:
+        raise InvalidJWTError('Token must have 3 segments')
+    header_seg, payload_seg, signature_seg = segments
+    try:
+        header = json.loads(_b64decode(header_seg))
+        signature = _b64decode(signature_seg)
+    except Exception:
+        raise InvalidJWTError('Malformed token header or signature')
+    alg = header.get('alg') if isinstance(header, dict) else None
+    if alg not in _HMAC_ALGORITHMS or alg not in algorithms:
+        raise InvalidJWTError('Algorithm not allowed: %s' % alg)
+
+    expected = hmac.new(
+        key, header_seg + b'.' + payload_seg, _HMAC_ALGORITHMS[alg]
+    ).digest()
+    if not hmac.compare_digest(expected, signature):
+        raise InvalidJWTError('Signature verification failed')
+
+    try:
+        raw = _b64decode(payload_seg)
+        payload = json.loads(raw)
+    except Exception:
+        raise InvalidJWTError('Malformed token payload')
+    if not isinstance(payload, dict):
+        raise InvalidJWTError('Token payload must be a JSON object')
+    _check_time_claims(payload, now, leeway, verify_exp)
+
+    if cache is not None:
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)):
+            exp = None
+        cache.set(ckey, (alg, raw, exp))
+    return payload
+
+
+# JWT shaped candidates, starting with the literal so re can skip ahead
+_JWT_SCAN_RE = re.compile(
+    rb'eyJ[A-Za-z0-9_-]+={0,2}\.[A-Za-z0-9_-]+={0,2}\.[A-Za-z0-9_-]{10,}={0,2}'
+)
+# bytes which can be part of a token
+_JWT_BYTES = (
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-=.'
+)
+_B64URL_BYTES = frozenset(_JWT_BYTES[:-2])
+
+
+def _scan_buffer(
+    buf: Any, base: int, strict: bool
+) -> Iterator[Tuple[int, bytes]]:
+    for match in _JWT_SCAN_RE.finditer(buf):
+        start = match.start()
+        # part of a longer base64url run, not a token of its own
+        if start and buf[start - 1] in _B64URL_BYTES:
+            continue
+        token = match.group()
+        if is_jwt(token, strict):
+            yield base + start, token
+
+
+def scan_jwts(
+    source: Union[str, bytes, os.PathLike], strict: bool = False
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Find JWTs in a file, memory mapped, or in a bytes-like object.
+    Candidates are found with a compiled bytes regex and confirmed
+    with is_jwt().
+    Args:
+        source (Union[str, bytes, PathLike]): A file path, or the bytes
+            (bytes, bytearray, memoryview, mmap) to scan.
+        strict (bool): Passed to is_jwt(). Defaults to False.
+    Returns:
+        Iterator[Tuple[int, bytes]]: (byte offset, token) pairs.
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        yield from _scan_buffer(source, 0, strict)
+        return
+    with open(source, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _scan_buffer(mm, 0, strict)
+
+
+def scan_jwt_stream(
+    chunks: Iterable[bytes], strict: bool = False, max_token: int = 16384
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Find JWTs in a stream of byte chunks, tokens may be split across
+    chunk boundaries. Only the trailing bytes of a chunk which could
+    still belong to a token (at most $max_token) are carried over.
+    Args:
+        chunks (Iterable[bytes]): The byte chunks, e.g. file reads.
+        strict (bool): Passed to is_jwt(). Defaults to False.
+        max_token (int): Longest token to detect across chunks.
+    Returns:
+        Iterator[Tuple[int, bytes]]: (byte offset, token) pairs.
+    """
+    carry = b''
+    base = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf = carry + chunk if carry else bytes(chunk)
+        # start of the trailing run of bytes which may continue a token
+        window = buf[-max_token:]
+        tail = len(buf) - len(window) + len(window.rstrip(_JWT_BYTES))
+        for offset, token in _scan_buffer(buf, base, strict):
+            if offset - base + len(token) <= tail:
+                yield offset, token
+        # tokens reaching into the tail are found again with the next chunk
+        carry = buf[tail:]
+        base += tail
+    if carry:
+        yield from _scan_buffer(carry, base, strict)
+
+
+def _scan_file(path: str, strict: bool) -> List[Tuple[int, bytes]]:
+    return list(scan_jwts(path, strict))
+
+
+def scan_jwt_files(
+    paths: Iterable[Union[str, os.PathLike]],
+    strict: bool = False,
+    max_workers: Optional[int] = None,
+) -> Iterator[Tuple[str, int, bytes]]:
+    """
+    Find JWTs in many files with scan_jwts() across a process pool.
+    Args:
+        paths (Iterable[Union[str, PathLike]]): The files to scan.
+        strict (bool): Passed to is_jwt(). Defaults to False.
+        max_workers (Optional[int]): Pool size, defaults to CPU count.
+    Returns:
+        Iterator[Tuple[str, int, bytes]]: (path, byte offset, token),
+            grouped by file in input order.
+    """
+    paths = [os.fspath(p) for p in paths]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(partial(_scan_file, strict=strict), paths)
+        for path, found in zip(paths, results):
+            for offset, token in found:
+                yield path, offset, token
+
+
+_DIGEST_BUFSIZE = 1024 * 1024
+_TREE_CHUNK_SIZE = 64 * 1024 * 1024
+_buffers = threading.local()
+
+
+def _read_buffer(size: int) -> memoryview:
+    """Returns a per thread reusable buffer of $size bytes"""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = memoryview(bytearray(size))
+    return buf
+
+
+def _hash_range(
+    path: str, algo: str, offset: int, length: Optional[int], bufsize: int
+) -> Any:
+    """Hashes $length bytes (None for all) of $path from $offset"""
+    h = hashlib.new(algo)
+    buf = _read_buffer(bufsize)
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        while length is None or length > 0:
+            n = bufsize if length is None else min(bufsize, length)
+            n = f.readinto(buf[:n])
+            if not n:
+                break
+            h.update(buf[:n])
+            if length is not None:
+                length -= n
+    return h
+
+
+def file_digest(
+    path: Union[str, os.PathLike],
+    algo: str = 'sha256',
+    bufsize: int = _DIGEST_BUFSIZE,
+    tree: bool = False,
+    chunk_size: int = _TREE_CHUNK_SIZE,
+    max_workers: Optional[int] = None,
+) -> str:
+    """
+    Hash a file with readinto() a reused buffer, no per chunk allocation.
+    In tree mode the file is split into $chunk_size chunks hashed in
+    parallel threads (hashlib releases the GIL), the result is the hash
+    of the concatenated chunk digests. Tree digests therefore differ from
+    plain ones and only match tree digests with the same $chunk_size.
+    Args:
+        path (Union[str, PathLike]): The file to hash.
+        algo (str): Any hashlib.new() algorithm. Defaults to sha256.
+        bufsize (int): Read buffer size. Defaults to 1 MiB.
+        tree (bool): Hash chunks in parallel. Defaults to False.
+        chunk_size (int): Tree mode chunk size. Defaults to 64 MiB.
+        max_workers (Optional[int]): Tree mode threads.
+    Returns:
+        str: The hex digest.
+    """
+    path = os.fspath(path)
+    if not tree:
+        return _hash_range(path, algo, 0, None, bufsize).hexdigest()
+
+    size = os.path.getsize(path)
+    offsets = range(0, max(size, 1), chunk_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        digests = pool.map(
+            lambda off: _hash_range(path, algo, off, chunk_size, bufsize),
+            offsets,
+        )
+        top = hashlib.new(algo)
+        for digest in digests:
+            top.update(digest.digest())
+    return top.hexdigest()
+
+
+def digest_many(
+    paths: Iterable[Union[str, os.PathLike]],
+    algo: str = 'sha256',
+    max_workers: Optional[int] = None,
+    **kwargs
+) -> Dict[str, str]:
+    """
+    Hash many files with file_digest() across a thread pool.
+    Args:
+        paths (Iterable[Union[str, PathLike]]): The files to hash.
+        algo (str): Any hashlib.new() algorithm. Defaults to sha256.
+        max_workers (Optional[int]): Number of threads.
+        **kwargs: Passed to file_digest().
+    Returns:
+        Dict[str, str]: Hex digest by path, in input order.
+    """
+    paths = [os.fspath(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        digests = pool.map(lambda p: file_digest(p, algo, **kwargs), paths)
+        return dict(zip(paths, digests))
@@ -1,5 +1,15 @@
 import os
-from typing import Union as U, Optional as Opt, Any as A
+import re
+from typing import (
+    Any as A,
+    Dict,
+    List,
+    Mapping,
+    Optional as Opt,
+    Set,
+    Tuple,
+    Union as U,
+)
 
 
 def typed_evar(
@@ -28,13 +38,20 @@ def typed_evar(
     varval = os.environ.get(name)
     if varval is None:
         return default
+    return _cast_evar(varval, default, vartype)
 
+
+_true = ('1', 'true', 'yes', 'on')
+_false = ('0', 'false', 'no', 'off')
+
+
+def _cast_evar(
+    varval: str, default: Opt[A] = None, vartype: U[type, A] = None
+) -> A:
+    """Applies the typed_evar typing rules to a raw value."""
     if vartype is not None:
         return vartype(varval)
 
-    _true = ('1', 'true', 'yes', 'on')
-    _false = ('0', 'false', 'no', 'off')
-
     deftype = type(default) if default is not None else None
     if deftype is not None:
         if deftype is bool:
@@ -61,3 +78,254 @@ def typed_evar(
                 return float(varval)
 
     return str(varval)
+
+
+class EnvVar:
+    """Declares an EnvSettings field that needs more than a default.
+    ?default (Any): value when unset, its type drives the cast like in
+        typed_evar
+    ?vartype (type): cast to this type instead
+    ?name (str): environment variable name, defaults to the attribute name
+    ?required (bool): raise KeyError at parse time when unset
+    """
+
+    __slots__ = ('default', 'vartype', 'name', 'required')
+
+    def __init__(
+        self,
+        default: Opt[A] = None,
+        vartype: U[type, A] = None,
+        name: Opt[str] = None,
+        required: bool = False,
+    ):
+        self.default = default
+        self.vartype = vartype
+        self.name = name
+        self.required = required
+
+
+class EnvSettings:
+    """Declarative snapshot of typed environment variables. Subclass it
+    with public class attributes as fields, a plain value is the default
+    (like typed_evar's default) and EnvVar sets the rest. Every field is
+    parsed once with the typed_evar rules into a frozen instance
+    attribute, so reads are plain attribute lookups. reload() re-parses
+    and changed() reports which variables differ from the snapshot.
+
+    class Settings(EnvSettings):
+        DEBUG = False
+        WORKERS = 4
+        RATE = EnvVar(vartype=float, name='APP_RATE')
+
+    ?environ (Mapping): source of the values, defaults to os.environ
+    """
+
+    _fields: Dict[str, EnvVar] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if attr.startswith('_') or callable(value):
+                    continue
+                if isinstance(value, (classmethod, staticmethod, property)):
+                    continue
+                if not isinstance(value, EnvVar):
+                    value = EnvVar(value)
+                fields[attr] = value
+        cls._fields = fields
+
+    def __init__(self, environ: Opt[Mapping[str, str]] = None):
+        object.__setattr__(self, '_environ', environ)
+        object.__setattr__(self, '_raw', {})
+        self.reload()
+
+    def _parse(
+        self, environ: Mapping[str, str]
+    ) -> Tuple[Dict[str, A], Dict[str, Opt[str]]]:
+        values, raw = {}, {}
+        for attr, field in self._fields.items():
+            name = field.name or attr
+            varval = environ.get(name)
+            raw[attr] = varval
+            if varval is None:
+                if field.required:
+                    raise KeyError(
+                        'Environment variable %s is not set' % name
+                    )
+                values[attr] = field.default
+                continue
+            try:
+                values[attr] = _cast_evar(varval, field.default, field.vartype)
+            except ValueError as e:
+                raise ValueError('Environment variable %s: %s' % (name, e))
+        return values, raw
+
+    def reload(self) -> Set[str]:
+        """Re-parses every field from the environment.
+        -> Set[str]: the attribute names whose value changed
+        """
+        environ = os.environ if self._environ is None else self._environ
+        values, raw = self._parse(environ)
+        changed = set()
+        for attr, value in values.items():
+            if attr not in self.__dict__ or self.__dict__[attr] != value:
+                changed.add(attr)
+                object.__setattr__(self, attr, value)
+        object.__setattr__(self, '_raw', raw)
+        return changed
+
+    def changed(self) -> Set[str]:
+        """Compares the raw environment with the snapshot without parsing.
+        -> Set[str]: the attribute names whose variable changed
+        """
+        environ = os.environ if self._environ is None else self._environ
+        return {
+            attr
+            for attr, field in self._fields.items()
+            if environ.get(field.name or attr) != self._raw[attr]
+        }
+
+    def as_dict(self) -> Dict[str, A]:
+        return {attr: self.__dict__[attr] for attr in self._fields}
+
+    def __setattr__(self, name: str, value: A):
+        raise AttributeError('%s is frozen' % type(self).__name__)
+
+    def __delattr__(self, name: str):
+        raise AttributeError('%s is frozen' % type(self).__name__)
+
+    def __repr__(self) -> str:
+        return '<%s %s>' % (
+            type(self).__name__,
+            ', '.join('%s=%r' % item for item in self.as_dict().items()),
+        )
+
+
+_DOTENV_RE = re.compile(
+    r"""
+    ^[ \t]*(?:export[ \t]+)?
+    (?P<key>[A-Za-z_][A-Za-z0-9_.]*)[ \t]*=[ \t]*
+    (?:
+        '(?P<single>[^']*)'
+        | "(?P<double>(?:\\.|[^"\\])*)"
+        | (?P<bare>[^\n]*)
+    )
+    """,
+    re.M | re.X,
+)
+_DOTENV_COMMENT_RE = re.compile(r'(?:^|[ \t]+)#')
+_DOTENV_ESCAPE_RE = re.compile(r'\\(.)', re.S)
+_DOTENV_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+_DOTENV_VAR_RE = re.compile(
+    r'\$\{([A-Za-z_][A-Za-z0-9_.]*)(?::?-([^}]*))?\}'
+)
+
+# path -> [st_mtime_ns, st_size, entries, resolved], resolved holds the
+# interpolated values with the referenced variables they were built from
+_dotenv_cache: Dict[str, List] = {}
+
+
+def parse_dotenv(text: str) -> List[Tuple[str, str, bool]]:
+    """Parses the KEY=VALUE lines of a .env file in one regex pass.
+    Single quoted values are literal, double quoted values may span lines
+    and take backslash escapes, unquoted values end at a ' #' comment.
+    ~text (str): the file content
+    -> List[Tuple[str, str, bool]]: (key, value, needs interpolation)
+    """
+    entries = []
+    for match in _DOTENV_RE.finditer(text):
+        key, single, double, bare = match.group(
+            'key', 'single', 'double', 'bare'
+        )
+        if single is not None:
+            entries.append((key, single, False))
+            continue
+        if double is not None:
+            value = _DOTENV_ESCAPE_RE.sub(
+                lambda m: _DOTENV_ESCAPES.get(m.group(1), m.group(1)), double
+            )
+        else:
+            value = _DOTENV_COMMENT_RE.split(bare, 1)[0].strip()
+        entries.append((key, value, '${' in value))
+    return entries
+
+
+def _interpolate_dotenv(
+    entries: List[Tuple[str, str, bool]],
+    environ: Mapping[str, str],
+    override: bool,
+) -> Tuple[Dict[str, str], Dict[str, Opt[str]]]:
+    values, refs = {}, {}
+
+    def resolve(match):
+        name, default = match.groups()
+        refs[name] = None
+        if override:
+            value = values.get(name, environ.get(name))
+        else:
+            value = environ.get(name, values.get(name))
+        if not value and default is not None:
+            return default
+        return value or ''
+
+    for key, value, interpolate in entries:
+        if interpolate:
+            value = _DOTENV_VAR_RE.sub(resolve, value)
+        values[key] = value
+    return values, refs
+
+
+def load_dotenv(
+    path: str = '.env',
+    override: bool = False,
+    apply: bool = True,
+    typed: bool = False,
+    environ: Opt[Dict[str, str]] = None,
+) -> Dict[str, A]:
+    """Loads a .env file into the environment. The parse and the
+    interpolated values are cached by path, mtime and size, so loading an
+    unchanged file again costs a stat and a lookup of the referenced
+    variables. ${VAR} and ${VAR:-default} resolve from the environment
+    and the earlier keys of the file, the file wins only with override.
+    ~path (str): the .env file
+    ?override (bool): replace variables that are already set
+    ?apply (bool): write the values into environ, else only return them
+    ?typed (bool): return the values cast with the typed_evar rules
+    ?environ (dict): target environment, defaults to os.environ
+    -> Dict[str, Any]: the values of the file
+    """
+    path = os.path.abspath(os.fspath(path))
+    stat = os.stat(path)
+    cached = _dotenv_cache.get(path)
+    if cached is None or cached[:2] != [stat.st_mtime_ns, stat.st_size]:
+        with open(path, encoding='utf-8') as f:
+            entries = parse_dotenv(f.read())
+        cached = [stat.st_mtime_ns, stat.st_size, entries, None]
+        _dotenv_cache[path] = cached
+
+    environ = os.environ if environ is None else environ
+    resolved = cached[3]
+    if (
+        resolved is not None
+        and resolved[0] == override
+        and all(environ.get(k) == v for k, v in resolved[1].items())
+    ):
+        values = resolved[2]
+    else:
+        values, refs = _interpolate_dotenv(cached[2], environ, override)
+        resolved = None
+
+    if apply:
+        for key, value in values.items():
+            if override or key not in environ:
+                environ[key] = value
+    if resolved is None:
+        # snapshot after applying, so the next load sees the same inputs
+        refs = {name: environ.get(name) for name in refs}
+        cached[3] = (override, refs, values)
+
+    if typed:
+        return {key: _cast_evar(value) for key, value in values.items()}
+    return dict(values)
@@ -25,3 +25,25 @@ class NotPrintableError(ValueError):
 
     def __repr__(self):
         return self.message  # pragma: no cover
+
+
+class InvalidJWTError(ValueError):
+    """
+    Raised when a JWT cannot be decoded or fails verification.
+
+    ~reason: Why the token was rejected.
+    -> None
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+        super().__init__(reason)
+
+
+class ExpiredJWTError(InvalidJWTError):
+    """
+    Raised when a JWT is past its 'exp' claim.
+
+    ~reason: Why the token was rejected.
+    -> None
+    """
@@ -1,12 +1,62 @@
+import atexit
+import copy
+import functools
+import gzip
+import json
+import mmap
 import os
-from typing import Optional as Opt
-from logging import getLogger, StreamHandler, Formatter
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import (
+    Any as A,
+    Callable,
+    Dict,
+    Iterable as Iter,
+    Iterator,
+    List,
+    Tuple,
+    Optional as Opt,
+    Sequence as Seq,
+    Union as U,
+)
+from logging import (
+    getLogger,
+    Filter,
+    Handler,
+    StreamHandler,
+    Formatter,
+    Logger,
+    LogRecord,
+    WARNING,
+    getLevelName,
+)
+from logging.handlers import (
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+    QueueHandler,
+    QueueListener,
+)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+try:
+    import lzma
+except ImportError:  # pragma: no cover, optional in minimal builds
+    lzma = None
 
 # Default constants from environment or hardcoded defaults
 _LOG_NAME = os.getenv('PYSHARED_LOG_NAME', 'pyshared')
 _LOG_FILE = os.getenv('PYSHARED_LOG_FILE', '/tmp/pyshared.log')
 _LOG_LEVEL = os.getenv('PYSHARED_LOG_LEVEL', 'DEBUG').upper()
+# 'json' selects JsonFormatter (JSON lines) instead of a format string
 _LOG_FORMAT = os.getenv(
     'PYSHARED_LOG_FORMAT',
     '%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -19,45 +69,1097 @@ _MAX_LOG_FILES = int(os.getenv('PYSHARED_MAX_LOG_FILES', 5))
 _FILE_LOGGING_ENABLED = os.getenv(
     'PYSHARED_FILE_LOGGING_ENABLED', 'True'
 ).lower() in ('true', '1', 'yes')
+# Time based rotation instead of size based, e.g. 'midnight', 'H', 'D'
+_LOG_ROTATE_WHEN = os.getenv('PYSHARED_LOG_ROTATE_WHEN', '')
+_LOG_ROTATE_INTERVAL = int(os.getenv('PYSHARED_LOG_ROTATE_INTERVAL', 1))
+# Compression of rotated files: 'gzip' or 'lzma', empty for none
+_LOG_COMPRESS = os.getenv('PYSHARED_LOG_COMPRESS', '').lower()
+# O_APPEND writes with lock file coordinated rotation, for forked workers
+_MULTIPROCESS_LOGGING = os.getenv(
+    'PYSHARED_LOG_MULTIPROCESS', 'False'
+).lower() in ('true', '1', 'yes')
+
+# Async logging, records are handed to a background thread via a queue
+_ASYNC_LOGGING = os.getenv('PYSHARED_LOG_ASYNC', 'False').lower() in (
+    'true',
+    '1',
+    'yes',
+)
+_QUEUE_SIZE = int(os.getenv('PYSHARED_LOG_QUEUE_SIZE', 10000))
+_QUEUE_OVERFLOW = os.getenv('PYSHARED_LOG_QUEUE_OVERFLOW', 'block').lower()
+_OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+# Per callsite rate limiting/sampling, 0 rate and 1.0 sample disable them
+_LOG_RATE_LIMIT = float(os.getenv('PYSHARED_LOG_RATE_LIMIT', 0))
+_LOG_RATE_BURST = int(os.getenv('PYSHARED_LOG_RATE_BURST', 10))
+_LOG_SAMPLE_RATE = float(os.getenv('PYSHARED_LOG_SAMPLE_RATE', 1.0))
+_LOG_LIMIT_KEY = os.getenv('PYSHARED_LOG_LIMIT_KEY', 'callsite').lower()
+
+# Ring buffer of records below the flush level, written only once a record
+# at/above it arrives, 0 disables buffering
+_LOG_BUFFER_SIZE = int(os.getenv('PYSHARED_LOG_BUFFER_SIZE', 0))
+_LOG_BUFFER_FLUSH_LEVEL = os.getenv(
+    'PYSHARED_LOG_BUFFER_FLUSH_LEVEL', 'ERROR'
+).upper()
+# records at/above this level bypass the buffer and are written at once
+_LOG_BUFFER_LEVEL = os.getenv('PYSHARED_LOG_BUFFER_LEVEL', 'WARNING').upper()
+
+# Configured loggers by name: (config key, handlers created for it)
+_registry: Dict[str, Tuple[tuple, List[Handler]]] = {}
+# File handlers shared between loggers by path: [handler, users]
+_file_handlers: Dict[str, list] = {}
+_registry_lock = threading.RLock()
+
+# Running queue listeners by logger name
+_listeners: Dict[str, QueueListener] = {}
+_listeners_lock = threading.Lock()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler over a bounded queue. When the queue is full, records
+    are handled according to $overflow:
+        block: wait for the listener to make room
+        drop_oldest: discard the oldest queued record
+        drop_newest: discard the record being logged
+    Discarded records are counted in $dropped.
+    """
+
+    def __init__(self, maxsize: int = _QUEUE_SIZE, overflow: str = 'block'):
+        if overflow not in _OVERFLOW_POLICIES:
+            raise ValueError(
+                'Invalid overflow policy: %s, expected one of %s'
+                % (overflow, ', '.join(_OVERFLOW_POLICIES))
+            )
+        super().__init__(queue.Queue(maxsize))
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # like QueueHandler.prepare, but the traceback stays in exc_text
+        # instead of being folded into msg, so formatters downstream see
+        # the same record shape as in sync mode
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(
+                    record.exc_info
+                )
+            record.exc_info = None
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: LogRecord) -> None:
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    return
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+
+_exc_formatter = Formatter()
+
+
+class _QueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # the queue may be full, wait for the listener to drain it instead
+        # of raising queue.Full like the default put_nowait()
+        self.queue.put(self._sentinel)
+
+
+# Attributes every LogRecord has, anything else was passed via extra=
+_RECORD_ATTRS = frozenset(
+    list(LogRecord('', 0, '', 0, '', (), None).__dict__)
+    + ['message', 'asctime']
+)
+_json_encode = json.JSONEncoder(
+    ensure_ascii=False, separators=(',', ':'), default=str
+).encode
+
+
+class JsonFormatter(Formatter):
+    """Formats records as single line JSON objects in one pass. The keys
+    are encoded once up front, the timestamp string is cached per second
+    and extra= fields are appended, with callables only being evaluated
+    when the record is actually formatted. extra= keys clashing with the
+    configured fields are written as extra_<key>.
+    ?fields (Seq[Tuple[str, str]]): (json key, record attribute) pairs
+        written first, default time, level, name and message.
+    ?datefmt (str): strftime format of the time, default
+        PYSHARED_DATE_FORMAT, milliseconds are appended.
+    """
+
+    default_fields = (
+        ('time', 'asctime'),
+        ('level', 'levelname'),
+        ('name', 'name'),
+        ('message', 'message'),
+    )
+
+    def __init__(
+        self,
+        fields: Opt[Seq[Tuple[str, str]]] = None,
+        datefmt: str = _DATE_FORMAT,
+    ):
+        super().__init__(datefmt=datefmt)
+        fields = fields if fields is not None else self.default_fields
+        self._templates = [
+            (('{' if i == 0 else ',') + _json_encode(key) + ':', attr)
+            for i, (key, attr) in enumerate(fields)
+        ]
+        # extra= keys clashing with these are written as extra_<key>
+        self._reserved = {key for key, _ in fields} | {'exc', 'stack'}
+        self._time_cache = (None, '')
+
+    def formatTime(self, record: LogRecord, datefmt: Opt[str] = None) -> str:
+        sec = int(record.created)
+        cached = self._time_cache
+        if cached[0] != sec:
+            stamp = time.strftime(
+                datefmt or self.datefmt, self.converter(record.created)
+            )
+            cached = self._time_cache = (sec, stamp)
+        return '%s.%03d' % (cached[1], record.msecs)
+
+    def format(self, record: LogRecord) -> str:
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+
+        parts = []
+        for prefix, attr in self._templates:
+            parts.append(prefix)
+            parts.append(_json_encode(getattr(record, attr, None)))
+        if not parts:
+            parts.append('{"message":' + _json_encode(record.message))
+
+        for key, value in record.__dict__.items():
+            if key in _RECORD_ATTRS:
+                continue
+            if callable(value):
+                value = value()
+            if key in self._reserved:
+                key = 'extra_' + key
+            parts.append(',' + _json_encode(key) + ':')
+            parts.append(_json_encode(value))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts.append(',"exc":' + _json_encode(record.exc_text))
+        if record.stack_info:
+            parts.append(',"stack":' + _json_encode(record.stack_info))
+        parts.append('}')
+        return ''.join(parts)
+
+
+class RateLimitFilter(Filter):
+    """Limits records per callsite (or per message template) with a token
+    bucket of $rate records per second and up to $burst at once, and/or
+    passes only a $sample fraction of them. As a logger filter it runs
+    before any formatting or handler I/O. The number of suppressed
+    records is appended to the next record passed for the same key
+    ("[suppressed N similar records]", also set as record.suppressed).
+    ?rate (float): Records per second per key, 0 for no rate limit.
+    ?burst (int): Bucket size, records allowed at once per key.
+    ?sample (float): Probability a record is passed, 1.0 for all.
+    ?key (str): 'callsite' (pathname, lineno) or 'template' (record.msg).
+    ?exempt_level (int): Records at or above this level always pass.
+    ?max_keys (int): Tracked keys before the state is reset.
+    """
+
+    def __init__(
+        self,
+        rate: float = _LOG_RATE_LIMIT,
+        burst: int = _LOG_RATE_BURST,
+        sample: float = _LOG_SAMPLE_RATE,
+        key: str = _LOG_LIMIT_KEY,
+        exempt_level: Opt[int] = None,
+        max_keys: int = 10000,
+    ):
+        super().__init__()
+        if key not in ('callsite', 'template'):
+            raise ValueError('Invalid rate limit key: %s' % key)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.sample = sample
+        self.by_callsite = key == 'callsite'
+        self.exempt_level = exempt_level
+        self.max_keys = max_keys
+        # key: [tokens, last refill, suppressed count]
+        self._state: Dict[A, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: LogRecord) -> bool:
+        exempt = self.exempt_level
+        if exempt is not None and record.levelno >= exempt:
+            return True
+        if self.by_callsite:
+            key = (record.pathname, record.lineno)
+        else:
+            key = record.msg
+
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                if len(self._state) >= self.max_keys:
+                    self._state.clear()
+                state = self._state[key] = [self.burst, now, 0]
+            if self.rate:
+                tokens = state[0] + (now - state[1]) * self.rate
+                state[0] = tokens if tokens < self.burst else self.burst
+                state[1] = now
+                if state[0] < 1:
+                    state[2] += 1
+                    return False
+                state[0] -= 1
+            if self.sample < 1.0 and random.random() >= self.sample:
+                state[2] += 1
+                return False
+            suppressed, state[2] = state[2], 0
+
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = '%s [suppressed %d similar records]' % (
+                record.msg,
+                suppressed,
+            )
+        return True
+
+    def pending(self) -> Dict[A, int]:
+        """Pops and returns the suppressed counts not yet reported"""
+        with self._lock:
+            counts = {k: v[2] for k, v in self._state.items() if v[2]}
+            for k in counts:
+                self._state[k][2] = 0
+        return counts
+
+    def report(self, logger: Logger) -> None:
+        """Logs a summary for each key with unreported suppressed records"""
+        for key, count in self.pending().items():
+            where = '%s:%s' % key if self.by_callsite else repr(key)
+            logger.warning(
+                'Suppressed %d similar records from %s', count, where
+            )
+
+
+def _level_number(level: U[int, str]) -> int:
+    if isinstance(level, int):
+        return level
+    number = getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError('Unknown level: %s' % level)
+    return number
+
+
+class RingBufferHandler(Handler):
+    """Keeps the last $capacity records below $buffer_level unformatted in
+    a preallocated ring buffer, and only passes them on to $targets, in
+    order, when a record at or above $flush_level arrives or dump() is
+    called. Older records are overwritten, nothing is formatted or
+    written until then. Records at or above $buffer_level (warnings by
+    default) are passed on right away.
+    ?capacity (int): Number of buffered records.
+    ?flush_level (U[int, str]): Level which triggers writing the buffer.
+    ?targets (Iter[Handler]): Handlers the records are passed on to.
+    ?buffer_level (U[int, str]): Level from which records are not
+        buffered, capped at $flush_level.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1000,
+        flush_level: U[int, str] = 'ERROR',
+        targets: Iter[Handler] = (),
+        buffer_level: U[int, str] = 'WARNING',
+    ):
+        super().__init__()
+        if capacity < 1:
+            raise ValueError('Ring buffer capacity must be at least 1')
+        self.capacity = capacity
+        self.flush_level = _level_number(flush_level)
+        self.buffer_level = min(_level_number(buffer_level), self.flush_level)
+        self.targets = list(targets)
+        self.buffer: List[Opt[LogRecord]] = [None] * capacity
+        self._pos = 0
+        self._count = 0
+
+    def emit(self, record: LogRecord) -> None:
+        if record.levelno >= self.flush_level:
+            self._drain()
+            self._send(record)
+            return
+        if record.levelno >= self.buffer_level:
+            self._send(record)
+            return
+        self.buffer[self._pos] = record
+        self._pos = (self._pos + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def _send(self, record: LogRecord) -> None:
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    def _drain(self) -> None:
+        start = (self._pos - self._count) % self.capacity
+        for i in range(self._count):
+            idx = (start + i) % self.capacity
+            record, self.buffer[idx] = self.buffer[idx], None
+            self._send(record)
+        self._count = 0
+
+    def dump(self) -> None:
+        """Writes out and clears the buffered records"""
+        self.acquire()
+        try:
+            self._drain()
+        finally:
+            self.release()
+
+    def flush(self) -> None:
+        for target in self.targets:
+            target.flush()
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def _make_formatter() -> Formatter:
+    """Returns the formatter selected by PYSHARED_LOG_FORMAT"""
+    if _LOG_FORMAT.lower() == 'json':
+        return JsonFormatter()
+    return Formatter(_LOG_FORMAT, _DATE_FORMAT)
+
+
+def _start_listener(name: str, handlers: list) -> BoundedQueueHandler:
+    """Moves $handlers to a background listener thread, returning the
+    queue handler to attach to the logger in their place
+    """
+    qhandler = BoundedQueueHandler(_QUEUE_SIZE, _QUEUE_OVERFLOW)
+    listener = _QueueListener(
+        qhandler.queue, *handlers, respect_handler_level=True
+    )
+    listener.qhandler = qhandler
+    listener.start()
+    with _listeners_lock:
+        _listeners[name] = listener
+    return qhandler
+
+
+def _stop_listener(name: str) -> None:
+    """Detaches, drains and stops the listener for the $name logger"""
+    with _listeners_lock:
+        listener = _listeners.pop(name, None)
+    if listener is None:
+        return
+    getLogger(name).removeHandler(listener.qhandler)
+    listener.stop()
+    if listener.qhandler.dropped:
+        record = LogRecord(
+            name,
+            WARNING,
+            __file__,
+            0,
+            'Dropped %d log records, queue was full',
+            (listener.qhandler.dropped,),
+            None,
+        )
+        for handler in listener.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+_COMPRESSORS = {
+    'gzip': ('.gz', gzip.open),
+    'lzma': ('.xz', lzma.open if lzma is not None else None),
+}
+
+
+class BackgroundCompressor:
+    """namer/rotator for rotating file handlers which compresses rotated
+    files on a background thread, so the logging call only pays for the
+    renames. A rotated file takes its backup slot uncompressed, later
+    rotations shift it like any other backup, and once the worker thread
+    compressed it the compressed file replaces it wherever it was shifted
+    to, so the order of the backups is decided at rotation time. The
+    worker is recreated in forked children.
+    ?method (str): 'gzip' (.gz) or 'lzma' (.xz).
+    ?lock_file (str): flock held while placing compressed files, for
+        handlers which coordinate rotation between processes with it.
+    """
+
+    def __init__(self, method: str = 'gzip', lock_file: Opt[str] = None):
+        if method not in _COMPRESSORS:
+            raise ValueError(
+                'Invalid compression: %s, expected one of %s'
+                % (method, ', '.join(_COMPRESSORS))
+            )
+        self.ext, self._open = _COMPRESSORS[method]
+        if self._open is None:
+            raise ImportError('%s is not available in this Python' % method)
+        self.lock_file = lock_file
+        self._pid = None
+        self._seq = 0
+        self._check_pid()
+
+    def _check_pid(self) -> None:
+        pid = os.getpid()
+        if pid != self._pid:
+            # a forked child inherits a dead worker thread, and maybe the
+            # lock it held, start over
+            self._pid = pid
+            self._lock = threading.Lock()
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending = deque()
+
+    def attach(self, handler: Handler) -> Handler:
+        """Sets the namer/rotator of $handler to use this compressor"""
+        handler.namer = self.namer
+        handler.rotator = self.rotator
+        handler.compressor = self
+        return handler
+
+    def namer(self, name: str) -> str:
+        return name + self.ext
+
+    def rotator(self, source: str, dest: str) -> None:
+        plain = dest[: -len(self.ext)] if dest.endswith(self.ext) else dest
+        self._check_pid()
+        with self._lock:
+            os.replace(source, plain)
+            self._submit(plain)
+
+    def rollover(self, handler: Handler) -> None:
+        """Shifts the numbered backups of $handler, moves its file to .1
+        and queues its compression. Handlers sharing the file between
+        processes call it holding their lock file."""
+        self._check_pid()
+        base = handler.baseFilename
+        with self._lock:
+            _shift_backups(handler, handler.backupCount)
+            os.replace(base, base + '.1')
+            self._submit(
+                base + '.1',
+                functools.partial(_find_backup, base, handler.backupCount),
+            )
+
+    def _submit(self, path: str, locate: Opt[Callable] = None) -> None:
+        """Queues the compression of $path to $path + ext, $locate(inode)
+        returns where the file was shifted to since, None once removed.
+        Called with the lock held."""
+        # opened now, the name may point to a newer backup by the time
+        # the worker gets to it
+        src = open(path, 'rb')
+        self._seq += 1
+        tmp = '%s%s.%d-%d.tmp' % (path, self.ext, self._pid, self._seq)
+        while self._pending and self._pending[0].done():
+            self._pending.popleft()
+        self._pending.append(
+            self._executor.submit(self._compress, src, tmp, path, locate)
+        )
+
+    def _compress(
+        self, src, tmp: str, path: str, locate: Opt[Callable]
+    ) -> None:
+        with src:
+            ino = os.fstat(src.fileno()).st_ino
+            try:
+                with self._open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        lockf = None
+        if self.lock_file is not None and fcntl is not None:
+            lockf = open(self.lock_file, 'a')
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            with self._lock:
+                if locate is not None:
+                    path = locate(ino)
+                elif _inode(path) != ino:
+                    path = None
+                if path is None:  # rotated out meanwhile
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, path + self.ext)
+                    os.remove(path)
+        finally:
+            if lockf is not None:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+                lockf.close()
+
+    def wait(self) -> None:
+        """Blocks until every queued compression of this process finished"""
+        if self._pid != os.getpid():
+            return
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending = self._pending.popleft()
+            pending.result()
+
+    def close(self) -> None:
+        self.wait()
+        if self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
 
-# Private global default logger instance
-_default_logger = None
+
+def _inode(path: str) -> Opt[int]:
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def _find_backup(base: str, backup_count: int, ino: int) -> Opt[str]:
+    """Returns the uncompressed backup of $base with inode $ino, if any"""
+    for i in range(1, backup_count + 1):
+        path = '%s.%d' % (base, i)
+        if _inode(path) == ino:
+            return path
+    return None
+
+
+def _backup_names(handler: Handler, i: int) -> Tuple[str, ...]:
+    """Returns the names backup $i of $handler may have: its rotated name
+    and, while it waits for compression, the plain one"""
+    plain = '%s.%d' % (handler.baseFilename, i)
+    named = handler.rotation_filename(plain)
+    return (named,) if named == plain else (named, plain)
+
+
+def _shift_backups(handler: Handler, backup_count: int) -> None:
+    """Moves $handler's backups N-1..1 to N..2"""
+    for i in range(backup_count - 1, 0, -1):
+        dests = _backup_names(handler, i + 1)
+        for src, dst in zip(_backup_names(handler, i), dests):
+            if not os.path.exists(src):
+                continue
+            for other in dests:
+                if other != dst and os.path.exists(other):
+                    os.remove(other)
+            os.replace(src, dst)
+
+
+class _CompressionMixin:
+    """Closes the BackgroundCompressor with the handler"""
+
+    compressor = None
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            self.compressor.close()
+        super().close()
+
+
+class _RotatingFileHandler(_CompressionMixin, RotatingFileHandler):
+    def doRollover(self) -> None:
+        if self.compressor is None or self.backupCount <= 0:
+            super().doRollover()
+            return
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.compressor.rollover(self)
+        if not self.delay:
+            self.stream = self._open()
+
+
+class _TimedRotatingFileHandler(_CompressionMixin, TimedRotatingFileHandler):
+    pass
+
+
+class MultiProcessRotatingFileHandler(Handler):
+    """Size rotated file handler which is safe to share between processes
+    (gunicorn/multiprocessing workers) writing to the same $filename.
+    Every record is a single os.write() on an O_APPEND descriptor, so
+    concurrent writers never interleave or overwrite each other. Before
+    each write the file size is checked with fstat, when over $maxBytes
+    the rotation is done under an flock on "$filename.lock"; a process
+    that finds the file was already rotated by another one only reopens.
+    Writers racing the size check may overshoot $maxBytes by a record.
+    ~filename (str): The log file path.
+    ?maxBytes (int): Rotate once the file reaches this size, 0 never.
+    ?backupCount (int): Number of $filename.N backups kept.
+    """
+
+    def __init__(
+        self, filename: str, maxBytes: int = 0, backupCount: int = 0
+    ):
+        if fcntl is None:  # pragma: no cover
+            raise OSError('Multiprocess logging requires fcntl (POSIX)')
+        super().__init__()
+        self.baseFilename = os.path.abspath(filename)
+        self.lockFilename = self.baseFilename + '.lock'
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.namer = None
+        self.rotator = None
+        self.compressor = None
+        self.fd = None
+        self._open()
+
+    def _open(self) -> None:
+        self.fd = os.open(
+            self.baseFilename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+    def _reopen(self) -> None:
+        os.close(self.fd)
+        self._open()
+
+    def rotation_filename(self, default_name: str) -> str:
+        if callable(self.namer):
+            return self.namer(default_name)
+        return default_name
+
+    def rotate(self, source: str, dest: str) -> None:
+        if callable(self.rotator):
+            self.rotator(source, dest)
+        else:
+            os.replace(source, dest)
+
+    def _rollover(self, pending: int) -> None:
+        """Rotates the file under the lock unless another process did"""
+        with open(self.lockFilename, 'a') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                try:
+                    st = os.stat(self.baseFilename)
+                except FileNotFoundError:
+                    st = None
+                ours = os.fstat(self.fd)
+                rotated = st is None or st.st_ino != ours.st_ino
+                full = st is not None and st.st_size > 0
+                full = full and st.st_size + pending > self.maxBytes
+                if not rotated and full:
+                    if self.backupCount > 0:
+                        self._shift_backups()
+                    else:
+                        os.truncate(self.baseFilename, 0)
+                self._reopen()
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _shift_backups(self) -> None:
+        if self.compressor is not None:
+            self.compressor.rollover(self)
+            return
+        _shift_backups(self, self.backupCount)
+        self.rotate(
+            self.baseFilename,
+            self.rotation_filename(self.baseFilename + '.1'),
+        )
+
+    def emit(self, record: LogRecord) -> None:
+        try:
+            data = (self.format(record) + '\n').encode('utf-8')
+            if self.maxBytes > 0:
+                size = os.fstat(self.fd).st_size
+                if size and size + len(data) > self.maxBytes:
+                    self._rollover(len(data))
+            os.write(self.fd, data)
+        except Exception:
+            self.handleError(record)
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            self.compressor.close()
+        self.acquire()
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.release()
+            super().close()
+
+
+def _acquire_file_handler(file_path: str) -> Handler:
+    """Returns the shared file handler for $file_path, creating it once"""
+    file_path = os.path.abspath(file_path)
+    entry = _file_handlers.get(file_path)
+    if entry is None:
+        if _MULTIPROCESS_LOGGING:
+            file_handler = MultiProcessRotatingFileHandler(
+                file_path, maxBytes=_MAX_LOG_SIZE, backupCount=_MAX_LOG_FILES
+            )
+        elif _LOG_ROTATE_WHEN:
+            file_handler = _TimedRotatingFileHandler(
+                file_path,
+                when=_LOG_ROTATE_WHEN,
+                interval=_LOG_ROTATE_INTERVAL,
+                backupCount=_MAX_LOG_FILES,
+            )
+        else:
+            file_handler = _RotatingFileHandler(
+                file_path, maxBytes=_MAX_LOG_SIZE, backupCount=_MAX_LOG_FILES
+            )
+        if _LOG_COMPRESS:
+            lock_file = getattr(file_handler, 'lockFilename', None)
+            BackgroundCompressor(_LOG_COMPRESS, lock_file).attach(file_handler)
+        file_handler.setFormatter(_make_formatter())
+        entry = _file_handlers[file_path] = [file_handler, 0]
+    entry[1] += 1
+    return entry[0]
+
+
+def _release_handler(handler: Handler) -> None:
+    """Closes $handler, shared file handlers only once unused"""
+    for file_path, entry in list(_file_handlers.items()):
+        if entry[0] is handler:
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del _file_handlers[file_path]
+            break
+    handler.close()
+
+
+def _release_logger(name: str) -> None:
+    """Detaches and closes the handlers get_logger created for $name"""
+    logger = getLogger(name)
+    for filt in list(logger.filters):
+        if isinstance(filt, RateLimitFilter):
+            logger.removeFilter(filt)
+            filt.report(logger)
+    _stop_listener(name)
+    logger.handlers = []  # Clear existing handlers to prevent duplicate logs
+    entry = _registry.pop(name, None)
+    if entry is not None:
+        for handler in entry[1]:
+            _release_handler(handler)
+
+
+@atexit.register
+def _release_loggers() -> None:
+    """Flushes all queued records and closes the handlers at exit"""
+    with _registry_lock:
+        for name in list(_registry):
+            _release_logger(name)
 
 
 def get_logger(
-    name: str = _LOG_NAME, level: Opt[str] = None, log_file: Opt[str] = None
+    name: str = _LOG_NAME,
+    level: Opt[str] = None,
+    log_file: Opt[str] = None,
+    async_mode: Opt[bool] = None,
+    buffer_size: Opt[int] = None,
 ):
-
-    global _default_logger
-    if name == _LOG_NAME and _default_logger is not None:
-        return _default_logger
+    """Returns a logger with console and (optionally) rotating file
+    handlers configured from the PYSHARED_* environment variables.
+    ~name (str): The logger name, default PYSHARED_LOG_NAME.
+    ?level (str): The log level, default PYSHARED_LOG_LEVEL.
+    ?log_file (str): The log file path, default PYSHARED_LOG_FILE.
+    ?async_mode (bool): Hand records to a background thread through a
+        bounded queue instead of writing on the calling thread, default
+        PYSHARED_LOG_ASYNC. The queue size and overflow policy come from
+        PYSHARED_LOG_QUEUE_SIZE and PYSHARED_LOG_QUEUE_OVERFLOW.
+    ?buffer_size (int): Keep up to this many records below
+        PYSHARED_LOG_BUFFER_LEVEL in a RingBufferHandler and only
+        write them when a record at/above PYSHARED_LOG_BUFFER_FLUSH_LEVEL
+        arrives, 0 to write every record, default
+        PYSHARED_LOG_BUFFER_SIZE.
+    -> Logger: The configured logger.
+    """
 
     log_level = level if level is not None else _LOG_LEVEL
     file_path = log_file if log_file is not None else _LOG_FILE
+    async_mode = async_mode if async_mode is not None else _ASYNC_LOGGING
+    buffer_size = buffer_size if buffer_size is not None else _LOG_BUFFER_SIZE
 
-    # Configure a new logger or the default one
-    logger = getLogger(name)
-    logger.setLevel(log_level)
-    logger.handlers = []  # Clear existing handlers to prevent duplicate logs
+    key = (
+        str(log_level).upper(),
+        os.path.abspath(file_path) if _FILE_LOGGING_ENABLED else None,
+        bool(async_mode),
+        buffer_size,
+    )
+    with _registry_lock:
+        entry = _registry.get(name)
+        if entry is not None and entry[0] == key:
+            return getLogger(name)
 
-    # Console Handler
-    console_handler = StreamHandler()
-    console_handler.setLevel(log_level)
-    console_format = Formatter(_LOG_FORMAT, _DATE_FORMAT)
-    console_handler.setFormatter(console_format)
-    logger.addHandler(console_handler)
-
-    # File Handler
-    if _FILE_LOGGING_ENABLED:
-        file_handler = RotatingFileHandler(
-            file_path, maxBytes=_MAX_LOG_SIZE, backupCount=_MAX_LOG_FILES
-        )
-        file_handler.setLevel(log_level)
-        file_format = Formatter(_LOG_FORMAT, _DATE_FORMAT)
-        file_handler.setFormatter(file_format)
-        logger.addHandler(file_handler)
+        # Configure a new logger, replacing a differently configured one
+        _release_logger(name)
+        logger = getLogger(name)
+        logger.setLevel(log_level)
+
+        # Rate limiting/sampling, applied before records reach handlers
+        if _LOG_RATE_LIMIT > 0 or _LOG_SAMPLE_RATE < 1.0:
+            logger.addFilter(RateLimitFilter())
+
+        # Console Handler
+        console_handler = StreamHandler()
+        console_handler.setLevel(log_level)
+        console_handler.setFormatter(_make_formatter())
+        handlers = [console_handler]
+
+        # File Handler, shared by every logger writing to the same path
+        if _FILE_LOGGING_ENABLED:
+            handlers.append(_acquire_file_handler(file_path))
+
+        outputs = handlers
+        if async_mode:
+            outputs = [_start_listener(name, handlers)]
+        # buffered on the calling thread, before the queue formats records
+        if buffer_size:
+            ring = RingBufferHandler(
+                buffer_size,
+                _LOG_BUFFER_FLUSH_LEVEL,
+                outputs,
+                _LOG_BUFFER_LEVEL,
+            )
+            outputs = [ring]
+        for handler in outputs:
+            logger.addHandler(handler)
 
-    if name == _LOG_NAME:
-        _default_logger = logger
+        _registry[name] = (key, handlers)
 
     return logger
+
+
+# Log file readers, for tail/time window searches over rotated files
+
+
+def _log_files(log_file: str) -> List[str]:
+    """Returns $log_file and its rotated backups, newest first"""
+    base = os.path.basename(log_file)
+    dirname = os.path.dirname(os.path.abspath(log_file))
+    numbered, dated = {}, {}
+    for fname in sorted(os.listdir(dirname)):
+        if not fname.startswith(base + '.'):
+            continue
+        suffix = fname[len(base) + 1 :]
+        if suffix.endswith(('.lock', '.tmp')) or suffix == 'lock':
+            continue
+        stem = suffix
+        for ext, _ in _COMPRESSORS.values():
+            if stem.endswith(ext):
+                stem = stem[: -len(ext)]
+        # a backup is briefly both plain and compressed while the
+        # BackgroundCompressor places it, sorted() lists the plain first
+        found = numbered if stem.isdigit() else dated
+        key = int(stem) if stem.isdigit() else stem
+        found.setdefault(key, os.path.join(dirname, fname))
+    files = [log_file] if os.path.exists(log_file) else []
+    files.extend(path for _, path in sorted(numbered.items()))
+    files.extend(path for _, path in sorted(dated.items(), reverse=True))
+    return files
+
+
+def _open_compressed(path: str):
+    """Returns an opener for compressed $path, None for plain files"""
+    for method, (ext, opener) in _COMPRESSORS.items():
+        if path.endswith(ext):
+            if opener is None:
+                raise ImportError('%s is not available to read %s' % (
+                    method, path))
+            return opener
+    return None
+
+
+def _tail_plain(path: str, n: int) -> List[bytes]:
+    """Returns the last $n lines of $path, scanning backwards with mmap"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = size - 1 if mm[size - 1 : size] == b'\n' else size
+            lines = []
+            while len(lines) < n and pos >= 0:
+                nl = mm.rfind(b'\n', 0, pos)
+                lines.append(mm[nl + 1 : pos])
+                pos = nl
+            lines.reverse()
+            return lines
+
+
+def tail_log(n: int = 10, log_file: Opt[str] = None) -> List[str]:
+    """Returns the last $n lines across the log file and its rotated
+    (optionally compressed) backups. Plain files are scanned backwards
+    with mmap, so only the end of the newest file is usually read.
+    ?n (int): Number of lines.
+    ?log_file (str): The log file path, default PYSHARED_LOG_FILE.
+    -> List[str]: The lines, oldest first, without line endings.
+    """
+    lines: List[bytes] = []
+    for path in _log_files(log_file if log_file is not None else _LOG_FILE):
+        need = n - len(lines)
+        if need <= 0:
+            break
+        opener = _open_compressed(path)
+        if opener is None:
+            found = _tail_plain(path, need)
+        else:
+            with opener(path, 'rb') as f:
+                found = [line.rstrip(b'\n') for line in deque(f, need)]
+        lines = found + lines
+    return [line.decode('utf-8', 'replace') for line in lines]
+
+
+class _LineTime:
+    """Parses the timestamp prefix of text or JSON log lines"""
+
+    json_prefix = b'{"time":"'
+
+    def __init__(self, date_format: str):
+        self.date_format = date_format
+        # assumes a fixed width format, like the default %Y-%m-%d %H:%M:%S
+        sample = datetime(2000, 12, 28, 23, 59, 59)
+        self.width = len(sample.strftime(date_format))
+
+    def __call__(self, line: bytes) -> Opt[datetime]:
+        if line.startswith(self.json_prefix):
+            line = line[len(self.json_prefix) :]
+        try:
+            return datetime.strptime(
+                line[: self.width].decode('utf-8'), self.date_format
+            )
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+
+def _first_stamped(mm, pos: int, line_time: _LineTime) -> Tuple[int, A]:
+    """Returns (offset, time) of the first timestamped line at/after $pos,
+    (len(mm), None) if there is none
+    """
+    size = len(mm)
+    while pos < size:
+        nl = mm.find(b'\n', pos)
+        end = size if nl == -1 else nl
+        stamp = line_time(mm[pos:end])
+        if stamp is not None:
+            return pos, stamp
+        pos = end + 1
+    return size, None
+
+
+def _search_plain(
+    path: str,
+    start: Opt[datetime],
+    end: Opt[datetime],
+    line_time: _LineTime,
+) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            pos = 0
+            if start is not None:
+                # binary search for the first line at or after $start
+                lo, hi = 0, size
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    line_start = 0 if mid == 0 else mm.find(b'\n', mid - 1)
+                    line_start = size if line_start == -1 else line_start
+                    line_start += 1 if mid else 0
+                    stamp = _first_stamped(mm, line_start, line_time)[1]
+                    if stamp is None or stamp >= start:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                line_start = 0 if lo == 0 else mm.find(b'\n', lo - 1)
+                line_start = size if line_start == -1 else line_start
+                pos = _first_stamped(
+                    mm, line_start + (1 if lo else 0), line_time
+                )[0]
+
+            while pos < size:
+                nl = mm.find(b'\n', pos)
+                line_end = size if nl == -1 else nl
+                line = mm[pos:line_end]
+                if end is not None:
+                    stamp = line_time(line)
+                    if stamp is not None and stamp >= end:
+                        return
+                yield line
+                pos = line_end + 1
+
+
+def _first_time(path: str, line_time: _LineTime) -> Opt[datetime]:
+    """Returns the first timestamp in $path, None if there is none"""
+    opener = _open_compressed(path) or open
+    with opener(path, 'rb') as f:
+        for line in f:
+            stamp = line_time(line)
+            if stamp is not None:
+                return stamp
+    return None
+
+
+def _search_stream(
+    lines: Iter[bytes],
+    start: Opt[datetime],
+    end: Opt[datetime],
+    line_time: _LineTime,
+) -> Iterator[bytes]:
+    inside = start is None
+    for line in lines:
+        line = line.rstrip(b'\n')
+        stamp = line_time(line)
+        if stamp is not None:
+            if end is not None and stamp >= end:
+                return
+            inside = start is None or stamp >= start
+        if inside:
+            yield line
+
+
+def search_log(
+    start: Opt[datetime] = None,
+    end: Opt[datetime] = None,
+    log_file: Opt[str] = None,
+    date_format: str = _DATE_FORMAT,
+) -> Iterator[str]:
+    """Yields the log lines with a timestamp in [$start, $end) across the
+    log file and its rotated (optionally compressed) backups, oldest
+    first. Lines without a timestamp (e.g. tracebacks) belong to the
+    record before them. Plain files are binary searched with mmap on the
+    timestamp prefix of each line, which must be formatted with
+    $date_format at the start of the line (or of a JSON line's "time").
+    ?start (datetime): Inclusive lower bound, None for no bound.
+    ?end (datetime): Exclusive upper bound, None for no bound.
+    ?log_file (str): The log file path, default PYSHARED_LOG_FILE.
+    ?date_format (str): default PYSHARED_DATE_FORMAT.
+    -> Iterator[str]: The matching lines without line endings.
+    """
+    line_time = _LineTime(date_format)
+    files = _log_files(log_file if log_file is not None else _LOG_FILE)
+    files.reverse()
+    firsts = [_first_time(path, line_time) for path in files]
+    for i, path in enumerate(files):
+        if end is not None and firsts[i] is not None and firsts[i] >= end:
+            break
+        # every record is older than the first one of the next file
+        newer = firsts[i + 1] if i + 1 < len(files) else None
+        if start is not None and newer is not None and newer < start:
+            continue
+
+        opener = _open_compressed(path)
+        if opener is None:
+            lines = _search_plain(path, start, end, line_time)
+            for line in lines:
+                yield line.decode('utf-8', 'replace')
+        else:
+            with opener(path, 'rb') as f:
+                lines = _search_stream(f, start, end, line_time)
+                for line in lines:
+                    yield line.decode('utf-8', 'replace')
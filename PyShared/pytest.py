@@ -1,41 +1,307 @@
+import atexit
+import functools
+import hashlib
 import os
 import os.path as op
+import pickle
 import pytest as pt
 import inspect
+import shutil
+import tempfile
+import threading
+from collections import deque
+from queue import Queue
 from .python import ranstr
 
-from typing import Callable as Call
+from typing import Any as A, Callable as Call, Optional as Opt
 
 _SCOPES = ['function', 'module', 'session']
 
+_FIXTURE_CACHE_DIR = os.environ.get(
+    'PYSHARED_FIXTURE_CACHE', op.join('.pytest_cache', 'pyshared_fixtures')
+)
+_FIXTURE_CACHE_SIZE = int(
+    os.environ.get('PYSHARED_FIXTURE_CACHE_SIZE', 512 * 1024 * 1024)
+)
 
-def multiscope_fixture(func: Call):
+
+def multiscope_fixture(
+    func: Opt[Call] = None,
+    *,
+    cache: bool = False,
+    version: A = None,
+    cache_dir: Opt[str] = None,
+    max_size: Opt[int] = None,
+):
     """Decorator to create a fixture for each scope (function, module, session)
     following the naming convention: {func_name}_{scope} as well as ensuring
     the original functional fixture is available under the original name.
 
     ~func (Call): The function to be decorated as a fixture.
+    ?cache (bool): Persist the results on disk between runs, see disk_cache.
+    ?version (Any): Bump to invalidate cached results, see disk_cache.
+    ?cache_dir (str): Cache directory, see disk_cache.
+    ?max_size (int): Cache size limit in bytes, see disk_cache.
     -> Call: The original function decorated for function scope.
     """
     # Get the globals of the calling module, not this module
     caller_globals = inspect.currentframe().f_back.f_globals
 
-    for sc in _SCOPES:
-        decorated = pt.fixture(scope=sc)(func)
-        caller_globals[f'{func.__name__}_{sc}'] = decorated
+    def register(func: Call) -> Call:
+        fixture_func = func
+        if cache:
+            fixture_func = disk_cache(
+                func, version=version, cache_dir=cache_dir, max_size=max_size
+            )
+        for sc in _SCOPES:
+            decorated = pt.fixture(scope=sc)(fixture_func)
+            caller_globals[f'{func.__name__}_{sc}'] = decorated
+
+        # Update the function to be the one decorated for function scope
+        return caller_globals[f'{func.__name__}_function']
+
+    if func is None:
+        return register
+    return register(func)
+
+
+def disk_cache(
+    func: Opt[Call] = None,
+    *,
+    version: A = None,
+    cache_dir: Opt[str] = None,
+    max_size: Opt[int] = None,
+):
+    """Decorator persisting a fixture's pickled result on disk so expensive
+    data is built once across pytest runs. Results are keyed by a hash of
+    the function's source, version and the pickled arguments and loaded
+    only when the fixture is requested. Once the directory grows past
+    max_size the least recently used results are evicted. Yield fixtures
+    can not be cached, unpicklable arguments or results skip the cache.
+
+    ~func (Call): The fixture function.
+    ?version (Any): Bump to invalidate results depending on outside data.
+    ?cache_dir (str): Cache directory, defaults to $PYSHARED_FIXTURE_CACHE
+        or .pytest_cache/pyshared_fixtures.
+    ?max_size (int): Cache size limit in bytes, defaults to
+        $PYSHARED_FIXTURE_CACHE_SIZE or 512MiB.
+    -> Call: The caching wrapper.
+    """
+    if func is None:
+        return functools.partial(
+            disk_cache, version=version, cache_dir=cache_dir, max_size=max_size
+        )
+    if inspect.isgeneratorfunction(func):
+        raise TypeError('%s yields and can not be cached' % func.__name__)
+
+    try:
+        source = inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        source = func.__code__.co_code
+    base = hashlib.sha256(
+        b'%s\0%s\0%s\0%s'
+        % (
+            func.__module__.encode(),
+            func.__qualname__.encode(),
+            source,
+            repr(version).encode(),
+        )
+    )
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            argkey = pickle.dumps((args, sorted(kwargs.items())))
+        except Exception:
+            return func(*args, **kwargs)
+        key = base.copy()
+        key.update(argkey)
+        cdir = cache_dir or _FIXTURE_CACHE_DIR
+        path = op.join(
+            cdir, '%s-%s.pickle' % (func.__name__, key.hexdigest()[:32])
+        )
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            # mtime tracks the last use for eviction
+            os.utime(path)
+            return result
+        except FileNotFoundError:
+            pass
+        except Exception:
+            _remove(path)
+
+        result = func(*args, **kwargs)
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return result
+        os.makedirs(cdir, exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        _evict(cdir, _FIXTURE_CACHE_SIZE if max_size is None else max_size)
+        return result
+
+    return wrapper
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _evict(cache_dir: str, max_size: int) -> None:
+    """Removes the least recently used results until the cache fits."""
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.pickle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= max_size:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        _remove(path)
+        total -= size
+        if total <= max_size:
+            break
+
+
+_TMPDIR_BASE = os.environ.get('PYSHARED_TMPDIR_BASE')
+_TMPDIR_POOL_SIZE = int(os.environ.get('PYSHARED_TMPDIR_POOL_SIZE', 8))
+
+
+def _tmpdir_base() -> str:
+    """/dev/shm when writable so test files stay in RAM, else the temp dir"""
+    if _TMPDIR_BASE:
+        return _TMPDIR_BASE
+    if op.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _empty_dir(path: str) -> None:
+    """Recursively removes everything inside path, keeping path itself."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _empty_dir(entry.path)
+                os.rmdir(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
+class TmpDirPool:
+    """Pool of pre-created temporary directories, on /dev/shm when
+    available. Released directories are emptied by a background thread
+    and handed out again, so tests neither wait on the cleanup nor on
+    creating fresh directories.
+
+    ?size (int): directories kept ready, defaults to
+        $PYSHARED_TMPDIR_POOL_SIZE or 8
+    ?base (str): parent directory, defaults to $PYSHARED_TMPDIR_BASE,
+        /dev/shm or the system temp dir
+    """
+
+    def __init__(self, size: int = _TMPDIR_POOL_SIZE, base: Opt[str] = None):
+        self.size = size
+        self.root = tempfile.mkdtemp(
+            prefix='pyshared-', dir=base or _tmpdir_base()
+        )
+        self._free = deque(self._new() for _ in range(size))
+        self._dirty = Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _new(self) -> str:
+        path = op.join(self.root, ranstr(min_len=15))
+        os.mkdir(path)
+        return path
+
+    def acquire(self) -> str:
+        """-> str: an empty directory"""
+        try:
+            return self._free.popleft()
+        except IndexError:
+            return self._new()
+
+    def release(self, path: str) -> None:
+        """Queues the directory for cleanup and reuse.
+        ~path (str): a directory from acquire()
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._clean, name='TmpDirPool', daemon=True
+                )
+                self._worker.start()
+        self._dirty.put(path)
+
+    def _clean(self) -> None:
+        while True:
+            path = self._dirty.get()
+            try:
+                if path is None:
+                    return
+                try:
+                    _empty_dir(path)
+                except OSError:
+                    shutil.rmtree(path, ignore_errors=True)
+                    path = self._new()
+                if len(self._free) < self.size:
+                    self._free.append(path)
+                else:
+                    os.rmdir(path)
+            except OSError:
+                pass
+            finally:
+                self._dirty.task_done()
+
+    def wait(self) -> None:
+        """Blocks until every released directory is cleaned."""
+        self._dirty.join()
+
+    def close(self) -> None:
+        """Stops the cleanup thread and removes every directory."""
+        with self._lock:
+            if self._worker is not None:
+                self._dirty.put(None)
+                self._worker.join()
+                self._worker = None
+        self._free.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+_tmpdir_pool = None
+_tmpdir_pool_lock = threading.Lock()
+
 
-    # Update the function to be the one decorated for function scope
-    func = caller_globals[f'{func.__name__}_function']
-    return func
+def tmpdir_pool() -> TmpDirPool:
+    """-> TmpDirPool: the shared pool behind the tmpdir fixtures, removed
+    at exit"""
+    global _tmpdir_pool
+    with _tmpdir_pool_lock:
+        if _tmpdir_pool is None:
+            _tmpdir_pool = TmpDirPool()
+            atexit.register(_tmpdir_pool.close)
+    return _tmpdir_pool
 
 
-@pt.fixture
+@multiscope_fixture
 def tmpdir():
-    """Creates a dir in /tmp/ with a random unique name, will delete after
-    yielding the new dir path
+    """Yields an empty dir from the shared TmpDirPool (in /dev/shm when
+    available) and recycles it in the background afterwards, whatever
+    the test wrote into it. Available as tmpdir_function, tmpdir_module
+    and tmpdir_session as well.
     """
-    name = ranstr(min_length=15)
-    tdir = op.join('/tmp', name)
-    os.mkdir(tdir)
+    pool = tmpdir_pool()
+    tdir = pool.acquire()
     yield tdir
-    os.rmdir(tdir)
+    pool.release(tdir)
@@ -176,6 +176,8 @@ class HumanTime:
     active = {k: None for k in incs}
 
     def _populate(self, ms: _TYPE_HTIME) -> None:
+        # per instance, the class level dict would leak units between calls
+        self.active = {k: None for k in self.incs}
         self.ms = D(str(ms)) if not isinstance(ms, D) else ms
         if self.ms < 10000:
             self.active['ms'] = self.ms.quantize(D('1.00'))
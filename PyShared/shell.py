@@ -1,25 +1,1144 @@
+import asyncio
+import os
+import selectors
+import signal
+import sys
 import typing as TYPE
-from shlex import split as shx_split
-from subprocess import run as sp_run, CompletedProcess
+from collections import OrderedDict
+from concurrent.futures import (
+    as_completed,
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+)
+from locale import getpreferredencoding
+from queue import Queue
+from shlex import quote as shx_quote, split as shx_split
+from subprocess import (
+    run as sp_run,
+    CalledProcessError,
+    CompletedProcess,
+    PIPE,
+    Popen,
+    TimeoutExpired,
+)
+from threading import Lock, Thread
+from time import monotonic
+from uuid import uuid4
+
+from .python import htime
+
+
+class CommandCache:
+    """LRU cache of CompletedProcess results for runcmd, meant for read
+    only commands like version probes. Entries are keyed by the split
+    argv, the working directory and the values of the env vars named in
+    env_keys, expire after ttl seconds and are dropped when a file they
+    watch has a different mtime than when they were stored.
+    Args:
+        maxsize (int): Maximum number of cached commands. Defaults to 256.
+        ttl (Optional[float]): Seconds an entry stays valid, None keeps it
+            until evicted. Defaults to None.
+        env_keys (Iterable[str]): Env vars that change the key.
+            Defaults to ('PATH',).
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: TYPE.Optional[float] = None,
+        env_keys: TYPE.Iterable[str] = ('PATH',),
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.env_keys = tuple(env_keys)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(
+        self,
+        argv: TYPE.List[str],
+        cwd: TYPE.Optional[str] = None,
+        env: TYPE.Optional[TYPE.Mapping[str, str]] = None,
+        input: TYPE.Optional[TYPE.AnyStr] = None,
+    ) -> TYPE.Tuple:
+        """Key identifying a command run.
+        Args:
+            argv (List[str]): The split command.
+            cwd (Optional[str]): Working directory, defaults to the current.
+            env (Optional[Mapping[str, str]]): Environment of the command,
+                defaults to os.environ.
+            input (Optional[AnyStr]): Data passed to the command's stdin.
+        Returns:
+            Tuple: The cache key.
+        """
+        env = os.environ if env is None else env
+        return (
+            tuple(os.fspath(arg) for arg in argv),
+            os.path.abspath(os.fspath(cwd) if cwd is not None else '.'),
+            tuple(env.get(key) for key in self.env_keys),
+            input,
+        )
+
+    @staticmethod
+    def _stamp(
+        watch: TYPE.Iterable[str],
+    ) -> TYPE.Tuple[TYPE.Tuple[str, TYPE.Optional[int]], ...]:
+        stamps = []
+        for path in watch:
+            try:
+                stamps.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                stamps.append((path, None))
+        return tuple(stamps)
+
+    def get(self, ckey: TYPE.Tuple) -> TYPE.Optional[CompletedProcess]:
+        """Looks up a stored result that has not expired or gone stale.
+        Args:
+            ckey (Tuple): Key from cache_key().
+        Returns:
+            Optional[CompletedProcess]: The result, None if missing.
+        """
+        with self._lock:
+            entry = self._entries.get(ckey)
+            if entry is not None:
+                expires, stamps, result = entry
+                if (
+                    expires is not None and monotonic() >= expires
+                ) or stamps != self._stamp(path for path, _ in stamps):
+                    del self._entries[ckey]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ckey)
+            self.hits += 1
+            return result
+
+    def set(
+        self,
+        ckey: TYPE.Tuple,
+        result: CompletedProcess,
+        watch: TYPE.Iterable[str] = (),
+    ) -> None:
+        """Stores a result, stamping the mtimes of the watched files.
+        Args:
+            ckey (Tuple): Key from cache_key().
+            result (CompletedProcess): The result to return on hits.
+            watch (Iterable[str]): Files whose mtime invalidates the entry.
+        """
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        entry = (expires, self._stamp(watch), result)
+        with self._lock:
+            self._entries[ckey] = entry
+            self._entries.move_to_end(ckey)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cmd_cache = CommandCache()
+# runcmd keyword arguments covered by the cache key, or not affecting
+# the output, any other one disables caching for that call
+_CACHE_KWARGS = frozenset(('cwd', 'env', 'input', 'timeout'))
+
+
+class CommandUsage(TYPE.NamedTuple):
+    """Resources used by one command, times in seconds and the peak
+    resident set size in bytes. On Linux the peak also covers the forked
+    interpreter before exec, so small commands report roughly the
+    parent's size."""
+
+    args: TYPE.List[str]
+    returncode: int
+    wall: float
+    user: float
+    sys: float
+    maxrss: int
+
+
+class UsageReport:
+    """Collects CommandUsage records across runcmd calls (usage=report)
+    and summarises them per command. Thread safe.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = Lock()
+
+    def add(self, usage: CommandUsage) -> None:
+        with self._lock:
+            self.records.append(usage)
+
+    def summary(
+        self, key: str = 'wall'
+    ) -> TYPE.List[TYPE.Tuple[str, int, float, float, float, int]]:
+        """Totals per command line sorted by the given field.
+        Args:
+            key (str): One of wall, user, sys, cpu or maxrss.
+                Defaults to 'wall'.
+        Returns:
+            List[Tuple[str, int, float, float, float, int]]: Rows of
+                (command, calls, wall, user, sys, peak maxrss).
+        """
+        totals = {}
+        with self._lock:
+            records = list(self.records)
+        for usage in records:
+            name = ' '.join(shx_quote(str(arg)) for arg in usage.args)
+            calls, wall, user, sys_, maxrss = totals.get(
+                name, (0, 0.0, 0.0, 0.0, 0)
+            )
+            totals[name] = (
+                calls + 1,
+                wall + usage.wall,
+                user + usage.user,
+                sys_ + usage.sys,
+                max(maxrss, usage.maxrss),
+            )
+        rows = [(name,) + total for name, total in totals.items()]
+        index = {'wall': 2, 'user': 3, 'sys': 4, 'maxrss': 6}
+        if key == 'cpu':
+            rows.sort(key=lambda row: row[3] + row[4], reverse=True)
+        else:
+            rows.sort(key=lambda row: row[index[key]], reverse=True)
+        return rows
+
+    def render(self, limit: TYPE.Optional[int] = 10, key: str = 'wall') -> str:
+        """Human readable summary, the most expensive commands first.
+        Args:
+            limit (Optional[int]): Number of commands listed, None for all.
+                Defaults to 10.
+            key (str): Sort field, see summary(). Defaults to 'wall'.
+        Returns:
+            str: One line per command followed by the totals.
+        """
+        rows = self.summary(key)
+        lines = []
+        for name, calls, wall, user, sys_, maxrss in rows[:limit]:
+            lines.append(
+                '%s: %d calls, wall %s, user %s, sys %s, max rss %.1fMB'
+                % (
+                    name,
+                    calls,
+                    htime(wall * 1000),
+                    htime(user * 1000),
+                    htime(sys_ * 1000),
+                    maxrss / 1048576,
+                )
+            )
+        lines.append(
+            'total: %d calls, wall %s, cpu %s'
+            % (
+                sum(row[1] for row in rows),
+                htime(sum(row[2] for row in rows) * 1000),
+                htime(sum(row[3] + row[4] for row in rows) * 1000),
+            )
+        )
+        return '\n'.join(lines)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+_MAXRSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+class _AccountedPopen(Popen):
+    """Popen reaping its child with os.wait4 to keep the child's rusage."""
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+
+def _run_accounted(
+    cmd: TYPE.List,
+    capture: bool,
+    *args,
+    input: TYPE.Optional[TYPE.AnyStr] = None,
+    timeout: TYPE.Optional[float] = None,
+    **kwargs
+) -> TYPE.Tuple[CompletedProcess, CommandUsage]:
+    if capture:
+        kwargs.update(stdout=PIPE, stderr=PIPE)
+    if input is not None:
+        kwargs['stdin'] = PIPE
+    start = monotonic()
+    with _AccountedPopen(cmd, *args, **kwargs) as proc:
+        try:
+            stdout, stderr = proc.communicate(input, timeout=timeout)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+    rusage = proc.rusage
+    usage = CommandUsage(
+        proc.args,
+        proc.returncode,
+        monotonic() - start,
+        rusage.ru_utime if rusage else 0.0,
+        rusage.ru_stime if rusage else 0.0,
+        rusage.ru_maxrss * _MAXRSS_SCALE if rusage else 0,
+    )
+    return CompletedProcess(proc.args, proc.returncode, stdout, stderr), usage
 
 
 def runcmd(
-    cmd: TYPE.Union[str, TYPE.List], output: bool = True, *args, **kwargs
-) -> TYPE.Optional[CompletedProcess]:
+    cmd: TYPE.Union[str, TYPE.List],
+    output: bool = True,
+    *args,
+    cache: TYPE.Union[CommandCache, bool] = False,
+    watch: TYPE.Iterable[str] = (),
+    usage: TYPE.Union[UsageReport, bool] = False,
+    **kwargs
+) -> TYPE.Union[
+    TYPE.Optional[CompletedProcess],
+    TYPE.Tuple[TYPE.Optional[CompletedProcess], TYPE.Optional[CommandUsage]],
+]:
     """Runs a single command in the shell with subprocess.run
     Args:
         cmd (Union[str, List]): The command to run in the shell.
         output (bool): Whether or not to return the output of the command.
             Defaults to True.
+        cache (Union[CommandCache, bool]): Cache successful results, True
+            for the shared module cache. Only used with output and only
+            meant for read only commands. The key covers cwd, input and
+            the cache's env_keys, calls passing any other subprocess
+            argument are not cached. Defaults to False.
+        watch (Iterable[str]): Files whose mtime change invalidates the
+            cached result. Defaults to ().
+        usage (Union[UsageReport, bool]): Measure the wall time, CPU time
+            and peak RSS of the command and return (result, CommandUsage),
+            a UsageReport also records it, failed commands included.
+            Cache hits report None. Defaults to False.
     """
     if isinstance(cmd, str):
         cmd = shx_split(cmd)
 
-    if output:
-        return sp_run(
+    # other Popen arguments may change the result, don't cache
+    cacheable = output and not args and not set(kwargs) - _CACHE_KWARGS
+    if cache is False or not cacheable:
+        cache = None
+    elif cache is True:
+        cache = _cmd_cache
+    if cache is not None:
+        ckey = cache.cache_key(
+            cmd, kwargs.get('cwd'), kwargs.get('env'), kwargs.get('input')
+        )
+        result = cache.get(ckey)
+        if result is not None:
+            return (result, None) if usage is not False else result
+
+    if usage is False:
+        if not output:
+            sp_run(
+                cmd,
+                check=False,
+                text=False,
+                capture_output=False,
+                *args,
+                **kwargs
+            )
+            return None
+        result = sp_run(
             cmd, check=True, text=True, capture_output=True, *args, **kwargs
         )
     else:
-        sp_run(
-            cmd, check=False, text=False, capture_output=False, *args, **kwargs
+        if output:
+            kwargs['universal_newlines'] = True
+        result, used = _run_accounted(cmd, output, *args, **kwargs)
+        if usage is not True:
+            usage.add(used)
+        if output:
+            result.check_returncode()
+
+    if cache is not None:
+        cache.set(ckey, result, watch)
+    if usage is False:
+        return result
+    return (result if output else None), used
+
+
+class _ProcessGroup:
+    """Tracks the processes started by runcmd_many so the first failure
+    can kill the running ones and cancel those not yet started."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.procs = set()
+        self.futures = []
+        self.error = None
+
+    def run(
+        self,
+        cmd: TYPE.Union[str, TYPE.List],
+        output: bool,
+        timeout: TYPE.Optional[float],
+        **kwargs
+    ) -> TYPE.Optional[CompletedProcess]:
+        if isinstance(cmd, str):
+            cmd = shx_split(cmd)
+        if output:
+            kwargs.update(stdout=PIPE, stderr=PIPE, universal_newlines=True)
+
+        if self.error is not None:
+            raise CancelledError()
+        proc = Popen(cmd, **kwargs)
+        with self.lock:
+            self.procs.add(proc)
+            if self.error is not None:
+                proc.kill()
+        with proc:
+            try:
+                stdout, stderr = proc.communicate(timeout=timeout)
+            except TimeoutExpired:
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                raise TimeoutExpired(proc.args, timeout, stdout, stderr)
+            finally:
+                with self.lock:
+                    self.procs.discard(proc)
+
+        if not output:
+            return None
+        if proc.returncode:
+            raise CalledProcessError(
+                proc.returncode, proc.args, stdout, stderr
+            )
+        return CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+    def fail(self, future: Future):
+        if future.cancelled() or future.exception() is None:
+            return
+        with self.lock:
+            if self.error is not None:
+                return
+            self.error = future.exception()
+            for pending in self.futures:
+                pending.cancel()
+            for proc in self.procs:
+                proc.kill()
+
+
+def runcmd_many(
+    cmds: TYPE.Iterable[TYPE.Union[str, TYPE.List]],
+    output: bool = True,
+    max_workers: TYPE.Optional[int] = None,
+    timeout: TYPE.Optional[float] = None,
+    ordered: bool = True,
+    fail_fast: bool = False,
+    **kwargs
+) -> TYPE.Iterator[TYPE.Optional[CompletedProcess]]:
+    """Runs many commands concurrently, at most max_workers at a time.
+    Each command follows runcmd: strings are split with shlex and with
+    output the result is captured as text and a non zero exit raises
+    CalledProcessError.
+    Args:
+        cmds (Iterable[Union[str, List]]): The commands to run.
+        output (bool): Passed through to every command, see runcmd.
+            Defaults to True.
+        max_workers (Optional[int]): Maximum number of commands running at
+            once. Defaults to the ThreadPoolExecutor default.
+        timeout (Optional[float]): Per command timeout in seconds, the
+            command is killed and TimeoutExpired raised once it passes.
+            Defaults to None.
+        ordered (bool): Yield results in input order, otherwise in
+            completion order. Defaults to True.
+        fail_fast (bool): On the first error kill the running commands,
+            skip the ones not yet started and raise that error. Otherwise
+            every command runs to completion and errors are raised when
+            their result is reached. Defaults to False.
+        **kwargs: Extra keyword arguments for subprocess.Popen.
+    Returns:
+        Iterator[Optional[CompletedProcess]]: One result per command.
+    """
+    group = _ProcessGroup()
+    with ThreadPoolExecutor(max_workers) as executor:
+        for cmd in cmds:
+            future = executor.submit(group.run, cmd, output, timeout, **kwargs)
+            with group.lock:
+                group.futures.append(future)
+            if fail_fast:
+                future.add_done_callback(group.fail)
+                if group.error is not None:
+                    future.cancel()
+
+        futures = group.futures
+        try:
+            for future in futures if ordered else as_completed(futures):
+                try:
+                    result = future.result()
+                except BaseException:
+                    if group.error is not None:
+                        raise group.error
+                    raise
+                if group.error is not None:
+                    raise group.error
+                yield result
+        except GeneratorExit:
+            if fail_fast:
+                for future in futures:
+                    future.cancel()
+            raise
+
+
+async def aruncmd(
+    cmd: TYPE.Union[str, TYPE.List],
+    output: bool = True,
+    timeout: TYPE.Optional[float] = None,
+    **kwargs
+) -> TYPE.Optional[CompletedProcess]:
+    """Asyncio counterpart of runcmd built on create_subprocess_exec.
+    Cancelling the awaiting task kills the command.
+    Args:
+        cmd (Union[str, List]): The command to run in the shell.
+        output (bool): Whether or not to return the output of the command,
+            a non zero exit then raises CalledProcessError. Defaults to True.
+        timeout (Optional[float]): Seconds before the command is killed and
+            TimeoutExpired raised. Defaults to None.
+        **kwargs: Extra keyword arguments for create_subprocess_exec.
+    Returns:
+        Optional[CompletedProcess]: The result when output is True.
+    """
+    if isinstance(cmd, str):
+        cmd = shx_split(cmd)
+    if output:
+        kwargs.update(stdout=PIPE, stderr=PIPE)
+
+    proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise TimeoutExpired(cmd, timeout)
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+
+    if not output:
+        return None
+    encoding = getpreferredencoding(False)
+    stdout = stdout.decode(encoding).replace('\r\n', '\n')
+    stderr = stderr.decode(encoding).replace('\r\n', '\n')
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+class StreamedProcess:
+    """Iterates over the output of a running command as it arrives,
+    created by runcmd_stream. Both pipes are drained with a selector so
+    neither can fill up and block the command, and at most chunk_size
+    bytes (max_line for an unterminated line) are held per pipe.
+
+    Iterating yields (name, data) tuples where name is 'stdout' or
+    'stderr'. Once exhausted returncode holds the exit code. Closing the
+    iterator or leaving the context manager early kills the command.
+    """
+
+    def __init__(
+        self,
+        cmd: TYPE.List,
+        lines: bool = True,
+        idle_timeout: TYPE.Optional[float] = None,
+        check: bool = True,
+        chunk_size: int = 65536,
+        max_line: int = 1048576,
+        **kwargs
+    ):
+        self.args = cmd
+        self.lines = lines
+        self.idle_timeout = idle_timeout
+        self.check = check
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self.encoding = kwargs.pop('encoding', None) or getpreferredencoding(
+            False
         )
+        self.errors = kwargs.pop('errors', None) or 'replace'
+        kwargs.setdefault('stdout', PIPE)
+        kwargs.setdefault('stderr', PIPE)
+        self.proc = Popen(cmd, **kwargs)
+        self.returncode = None
+
+    def __iter__(self) -> TYPE.Iterator[TYPE.Tuple[str, TYPE.AnyStr]]:
+        try:
+            yield from self._read()
+        finally:
+            if self.proc.returncode is None:
+                self.kill()
+
+    def _read(self) -> TYPE.Iterator[TYPE.Tuple[str, TYPE.AnyStr]]:
+        pending = {}
+        with selectors.DefaultSelector() as selector:
+            for name in ('stdout', 'stderr'):
+                pipe = getattr(self.proc, name)
+                if pipe is not None:
+                    selector.register(pipe, selectors.EVENT_READ, name)
+                    pending[name] = b''
+
+            while selector.get_map():
+                events = selector.select(self.idle_timeout)
+                if not events:
+                    self.kill()
+                    raise TimeoutExpired(self.args, self.idle_timeout)
+                for key, _ in events:
+                    name = key.data
+                    data = os.read(key.fd, self.chunk_size)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        if pending[name]:
+                            yield name, self._decode(pending[name])
+                        continue
+                    if not self.lines:
+                        yield name, data
+                        continue
+
+                    data = pending[name] + data
+                    end = data.rfind(b'\n') + 1
+                    if end:
+                        text = self._decode(data[:end]).split('\n')
+                        for i in range(len(text) - 1):
+                            yield name, text[i] + '\n'
+                    rest = data[end:]
+                    while len(rest) >= self.max_line:
+                        yield name, self._decode(rest[: self.max_line])
+                        rest = rest[self.max_line :]
+                    pending[name] = rest
+
+        self.returncode = self.proc.wait()
+        if self.check and self.returncode:
+            raise CalledProcessError(self.returncode, self.args)
+
+    def _decode(self, data: bytes) -> str:
+        return data.decode(self.encoding, self.errors)
+
+    def kill(self):
+        """Kills the command and reaps it."""
+        for pipe in (self.proc.stdout, self.proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        self.proc.kill()
+        self.returncode = self.proc.wait()
+
+    def __enter__(self) -> 'StreamedProcess':
+        return self
+
+    def __exit__(self, *exc):
+        if self.proc.returncode is None:
+            self.kill()
+
+
+def runcmd_stream(
+    cmd: TYPE.Union[str, TYPE.List],
+    lines: bool = True,
+    idle_timeout: TYPE.Optional[float] = None,
+    check: bool = True,
+    chunk_size: int = 65536,
+    **kwargs
+) -> StreamedProcess:
+    """Runs a command like runcmd but streams its output instead of
+    capturing it, so memory stays bounded however much it prints.
+    Args:
+        cmd (Union[str, List]): The command to run in the shell.
+        lines (bool): Yield decoded lines, newline included, otherwise raw
+            byte chunks as read from the pipes. Defaults to True.
+        idle_timeout (Optional[float]): Seconds without any output before
+            the command is killed and TimeoutExpired raised.
+            Defaults to None.
+        check (bool): Raise CalledProcessError after the output if the
+            exit code is non zero. Defaults to True.
+        chunk_size (int): Maximum bytes read per pipe at once.
+            Defaults to 65536.
+        **kwargs: Extra keyword arguments for StreamedProcess and
+            subprocess.Popen, stderr=subprocess.STDOUT merges the streams.
+    Returns:
+        StreamedProcess: Iterable of (name, data) with the exit code in
+            returncode once exhausted.
+    """
+    if isinstance(cmd, str):
+        cmd = shx_split(cmd)
+    return StreamedProcess(
+        cmd,
+        lines=lines,
+        idle_timeout=idle_timeout,
+        check=check,
+        chunk_size=chunk_size,
+        **kwargs
+    )
+
+
+class ShellSession:
+    """A long lived bash process running successive commands, which saves
+    the interpreter startup runcmd pays per call. Each command is run
+    through eval with stdin from /dev/null and followed by a unique
+    sentinel carrying its exit code, so output and status can be framed
+    on the shared pipes. Shell state such as the working directory and
+    variables persists between commands. If a command exits the shell,
+    closes its stdout or stderr, or times out a fresh one is started for
+    the next command. A command closing stdout leaves no exit code to
+    report and raises RuntimeError once it finished. A session runs
+    one command at a time, use ShellPool to share sessions between threads.
+    """
+
+    def __init__(
+        self,
+        shell: str = 'bash',
+        cwd: TYPE.Optional[str] = None,
+        env: TYPE.Optional[TYPE.Dict[str, str]] = None,
+    ):
+        self.shell = shell
+        self.cwd = cwd
+        self.env = env
+        self.encoding = getpreferredencoding(False)
+        self.proc = None
+        self.selector = None
+
+    def start(self):
+        """Starts the shell process, called on first use."""
+        self.proc = Popen(
+            [self.shell, '--noprofile', '--norc'],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+            cwd=self.cwd,
+            env=self.env,
+        )
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.proc.stdout, selectors.EVENT_READ)
+        self.selector.register(self.proc.stderr, selectors.EVENT_READ)
+
+    def run(
+        self,
+        cmd: TYPE.Union[str, TYPE.List],
+        check: bool = True,
+        timeout: TYPE.Optional[float] = None,
+    ) -> CompletedProcess:
+        """Runs a command in the session.
+        Args:
+            cmd (Union[str, List]): Shell code, a list is quoted and joined.
+            check (bool): Raise CalledProcessError on a non zero exit code.
+                Defaults to True.
+            timeout (Optional[float]): Seconds before the shell is killed
+                and TimeoutExpired raised. Defaults to None.
+        Returns:
+            CompletedProcess: The exit code with the stdout/stderr text.
+        Raises:
+            RuntimeError: The command closed the shell's stdout, so its
+                exit code is lost.
+        """
+        if not isinstance(cmd, str):
+            cmd = ' '.join(shx_quote(str(arg)) for arg in cmd)
+        if self.proc is None:
+            self.start()
+
+        token = uuid4().hex
+        script = (
+            'eval %s </dev/null\n'
+            'printf "\\n%s %%d\\n" $?\n'
+            'printf "\\n%s\\n" >&2\n' % (shx_quote(cmd), token, token)
+        )
+        try:
+            self.proc.stdin.write(script.encode(self.encoding))
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+        returncode, stdout, stderr = self._read(token.encode(), timeout, cmd)
+
+        result = CompletedProcess(
+            cmd,
+            returncode,
+            stdout.decode(self.encoding, 'replace'),
+            stderr.decode(self.encoding, 'replace'),
+        )
+        if check:
+            result.check_returncode()
+        return result
+
+    def _read(
+        self, token: bytes, timeout: TYPE.Optional[float], cmd: str
+    ) -> TYPE.Tuple[int, bytes, bytes]:
+        out_fd = self.proc.stdout.fileno()
+        err_fd = self.proc.stderr.fileno()
+        marks = {
+            out_fd: b'\n' + token + b' ',
+            err_fd: b'\n' + token + b'\n',
+        }
+        bufs = {out_fd: bytearray(), err_fd: bytearray()}
+        ends = {}
+        closed = set()
+        returncode = None
+        deadline = None if timeout is None else monotonic() + timeout
+
+        while len(closed) < 2 and (returncode is None or err_fd not in ends):
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - monotonic())
+            events = self.selector.select(wait)
+            if not events:
+                self.close()
+                raise TimeoutExpired(cmd, timeout)
+            for key, _ in events:
+                fd = key.fd
+                data = os.read(fd, 65536)
+                if not data:
+                    # the command exited the shell or closed this pipe,
+                    # no further command can be framed: end the script so
+                    # the shell exits once the command is done
+                    self.selector.unregister(key.fileobj)
+                    closed.add(fd)
+                    try:
+                        self.proc.stdin.close()
+                    except OSError:
+                        pass
+                    continue
+                buf = bufs[fd]
+                start = max(0, len(buf) - len(marks[fd]))
+                buf += data
+                if fd not in ends:
+                    end = buf.find(marks[fd], start)
+                    if end != -1:
+                        ends[fd] = end
+            # the exit code follows the stdout mark up to a newline
+            if returncode is None and out_fd in ends:
+                status = bufs[out_fd][ends[out_fd] + len(marks[out_fd]) :]
+                if status.endswith(b'\n'):
+                    returncode = int(status)
+
+        if closed:
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - monotonic())
+            try:
+                exitcode = self.proc.wait(wait)
+            except TimeoutExpired:
+                self.close()
+                raise TimeoutExpired(cmd, timeout)
+            self.close()
+            if returncode is None:
+                if ends:
+                    raise RuntimeError(
+                        'Command closed the shell stdout, its exit code is '
+                        'unknown: %s' % cmd
+                    )
+                # no sentinel at all, the command exited the shell
+                returncode = exitcode
+        return (
+            returncode,
+            bytes(bufs[out_fd][: ends.get(out_fd)]),
+            bytes(bufs[err_fd][: ends.get(err_fd)]),
+        )
+
+    def close(self):
+        """Stops the shell, the next command starts a new one."""
+        if self.proc is None:
+            return
+        self.selector.close()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def __enter__(self) -> 'ShellSession':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShellPool:
+    """A fixed number of ShellSession workers shared between threads, each
+    command runs on whichever session is idle."""
+
+    def __init__(self, size: int = 4, **kwargs):
+        self.size = size
+        self.sessions = [ShellSession(**kwargs) for _ in range(size)]
+        self.idle = Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+
+    def run(
+        self, cmd: TYPE.Union[str, TYPE.List], **kwargs
+    ) -> CompletedProcess:
+        """Runs a command on an idle session, see ShellSession.run."""
+        session = self.idle.get()
+        try:
+            return session.run(cmd, **kwargs)
+        finally:
+            self.idle.put(session)
+
+    def map(
+        self, cmds: TYPE.Iterable[TYPE.Union[str, TYPE.List]], **kwargs
+    ) -> TYPE.Iterator[CompletedProcess]:
+        """Runs the commands across all sessions, results in input order."""
+        with ThreadPoolExecutor(self.size) as executor:
+            futures = [
+                executor.submit(self.run, cmd, **kwargs) for cmd in cmds
+            ]
+            for future in futures:
+                yield future.result()
+
+    def close(self):
+        """Stops every session."""
+        for session in self.sessions:
+            session.close()
+
+    def __enter__(self) -> 'ShellPool':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PipelineResult(CompletedProcess):
+    """CompletedProcess of a pipeline, args holds every stage's argv and
+    returncodes every stage's exit code. returncode follows pipefail: the
+    last non zero stage code, ignoring earlier stages killed by SIGPIPE
+    because a later stage stopped reading."""
+
+    def __init__(
+        self,
+        args: TYPE.List[TYPE.List[str]],
+        returncodes: TYPE.List[int],
+        stdout: TYPE.Optional[TYPE.AnyStr] = None,
+        stderr: TYPE.Optional[TYPE.AnyStr] = None,
+    ):
+        self.returncodes = returncodes
+        super().__init__(args, _pipefail(returncodes), stdout, stderr)
+
+
+def _pipefail(returncodes: TYPE.List[int]) -> int:
+    last = len(returncodes) - 1
+    for i in range(last, -1, -1):
+        code = returncodes[i]
+        if code and (i == last or code != -signal.SIGPIPE):
+            return code
+    return 0
+
+
+class Pipeline:
+    """Running processes chained stdout to stdin with OS pipes, the data
+    between stages never passes through Python. Iterating yields the raw
+    output chunks of the last stage when it was started with stdout=PIPE,
+    then waits and checks the stages like pipeline().
+    Args:
+        cmds (List[List[str]]): The split stage commands.
+        stdin (Any): stdin of the first stage. Defaults to None.
+        stdout (Any): stdout of the last stage. Defaults to None.
+        stderr (Any): stderr of the last stage, earlier stages inherit
+            the parent's stderr. Defaults to None.
+        check (bool): Raise CalledProcessError after iterating on a
+            failed pipeline. Defaults to True.
+        **kwargs: Extra keyword arguments for every subprocess.Popen.
+    """
+
+    def __init__(
+        self,
+        cmds: TYPE.List[TYPE.List[str]],
+        stdin: TYPE.Any = None,
+        stdout: TYPE.Any = None,
+        stderr: TYPE.Any = None,
+        check: bool = True,
+        **kwargs
+    ):
+        self.args = cmds
+        self.check = check
+        self.procs = []
+        source = stdin
+        try:
+            for i, cmd in enumerate(cmds):
+                last = i == len(cmds) - 1
+                proc = Popen(
+                    cmd,
+                    stdin=source,
+                    stdout=stdout if last else PIPE,
+                    stderr=stderr if last else None,
+                    **kwargs
+                )
+                if i:
+                    # only the child may hold the read end, so the writer
+                    # gets SIGPIPE if the reader exits
+                    source.close()
+                source = proc.stdout
+                self.procs.append(proc)
+        except BaseException:
+            self.kill()
+            raise
+        self.stdin = self.procs[0].stdin
+        self.stdout = self.procs[-1].stdout
+        self.stderr = self.procs[-1].stderr
+
+    def __iter__(self) -> TYPE.Iterator[bytes]:
+        try:
+            fd = self.stdout.fileno()
+            data = os.read(fd, 65536)
+            while data:
+                yield data
+                data = os.read(fd, 65536)
+        finally:
+            if self.stdout is not None:
+                self.stdout.close()
+        result = PipelineResult(self.args, self.wait())
+        if self.check:
+            result.check_returncode()
+
+    def communicate(
+        self,
+        input: TYPE.Optional[TYPE.AnyStr] = None,
+        timeout: TYPE.Optional[float] = None,
+    ) -> TYPE.Tuple[TYPE.Optional[TYPE.AnyStr], TYPE.Optional[TYPE.AnyStr]]:
+        """Feeds input to the first stage, reads the last stage's output
+        and waits for every stage. On timeout all stages are killed.
+        Args:
+            input (Optional[AnyStr]): Data for the first stage's stdin.
+            timeout (Optional[float]): Seconds for the whole pipeline.
+        Returns:
+            Tuple[Optional[AnyStr], Optional[AnyStr]]: The last stage's
+                stdout and stderr if they were pipes.
+        """
+        first, last = self.procs[0], self.procs[-1]
+        feeder = None
+        if len(self.procs) > 1 and first.stdin is not None:
+            feeder = Thread(target=_feed, args=(first.stdin, input))
+            feeder.daemon = True
+            feeder.start()
+            input = None
+        deadline = None if timeout is None else monotonic() + timeout
+        try:
+            stdout, stderr = last.communicate(input, timeout)
+            self.wait(None if deadline is None else deadline - monotonic())
+        except TimeoutExpired:
+            self.kill()
+            raise TimeoutExpired(self.args, timeout)
+        if feeder is not None:
+            feeder.join()
+        return stdout, stderr
+
+    def wait(self, timeout: TYPE.Optional[float] = None) -> TYPE.List[int]:
+        """Waits for every stage and returns their exit codes."""
+        deadline = None if timeout is None else monotonic() + timeout
+        return [
+            proc.wait(None if deadline is None else deadline - monotonic())
+            for proc in self.procs
+        ]
+
+    def kill(self):
+        """Kills and reaps every stage."""
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+        for proc in self.procs:
+            proc.wait()
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, *exc):
+        for proc in self.procs:
+            for pipe in (proc.stdin, proc.stdout, proc.stderr):
+                if pipe is not None:
+                    pipe.close()
+        if exc[0] is not None:
+            self.kill()
+        else:
+            self.wait()
+
+
+def _feed(pipe: TYPE.IO, data: TYPE.Optional[bytes]):
+    try:
+        if data:
+            pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def pipeline(
+    cmds: TYPE.Iterable[TYPE.Union[str, TYPE.List]],
+    output: bool = True,
+    stream: bool = False,
+    input: TYPE.Optional[TYPE.AnyStr] = None,
+    stdin: TYPE.Any = None,
+    stdout: TYPE.Any = None,
+    timeout: TYPE.Optional[float] = None,
+    check: bool = True,
+    **kwargs
+) -> TYPE.Union[PipelineResult, Pipeline]:
+    """Runs commands as a pipeline like cmd1 | cmd2 | ... without a shell.
+    The stages are connected with OS pipes so intermediate data never
+    passes through Python, only the last stage's output is captured.
+    Args:
+        cmds (Iterable[Union[str, List]]): The stage commands, strings are
+            split with shlex.
+        output (bool): Capture the last stage's stdout and stderr as text.
+            Defaults to True.
+        stream (bool): Return the running Pipeline instead, iterating it
+            yields the last stage's stdout as raw chunks. Defaults to False.
+        input (Optional[AnyStr]): Data written to the first stage.
+            Defaults to None.
+        stdin (Any): stdin of the first stage, e.g. an open file.
+            Defaults to None.
+        stdout (Any): stdout of the last stage when not capturing, e.g. an
+            open file. Defaults to None.
+        timeout (Optional[float]): Seconds before every stage is killed and
+            TimeoutExpired raised. Defaults to None.
+        check (bool): Raise CalledProcessError if the pipefail exit code
+            is non zero. Defaults to True.
+        **kwargs: Extra keyword arguments for every subprocess.Popen.
+    Returns:
+        Union[PipelineResult, Pipeline]: The result with every stage's exit
+            code, or the running pipeline when streaming.
+    """
+    cmds = [shx_split(cmd) if isinstance(cmd, str) else cmd for cmd in cmds]
+    if not cmds:
+        raise ValueError('pipeline needs at least one command')
+    if stream:
+        return Pipeline(cmds, stdin=stdin, stdout=PIPE, check=check, **kwargs)
+
+    if isinstance(input, str):
+        input = input.encode(getpreferredencoding(False))
+    if input is not None:
+        stdin = PIPE
+    if output:
+        stdout = PIPE
+    with Pipeline(
+        cmds, stdin, stdout, PIPE if output else None, **kwargs
+    ) as pipe:
+        out, err = pipe.communicate(input, timeout)
+    result = PipelineResult(cmds, [proc.returncode for proc in pipe.procs])
+    if output:
+        encoding = getpreferredencoding(False)
+        result.stdout = out.decode(encoding).replace('\r\n', '\n')
+        result.stderr = err.decode(encoding).replace('\r\n', '\n')
+    if check:
+        result.check_returncode()
+    return result
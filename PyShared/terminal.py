@@ -1,5 +1,14 @@
 import os
+import signal
+import sys
+import threading
+import time
 import typing as TYPE
+import weakref
+from itertools import chain, islice
+
+from .log import get_logger
+from .python import htime, truncstr
 
 
 def get_terminal_width(default: int = 80) -> int:
@@ -10,8 +19,170 @@ def get_terminal_width(default: int = 80) -> int:
         return default
 
 
+class TerminalWriter:
+    """File-like writer which batches many small writes into few large
+    writes on the underlying stream. Usable as print(..., file=writer).
+    Args:
+        stream (TextIO): The stream to write to, defaults to sys.stdout.
+        bufsize (int) = 65536: Number of buffered chars before a flush.
+    """
+
+    def __init__(
+        self, stream: TYPE.Optional[TYPE.TextIO] = None, bufsize: int = 65536
+    ):
+        self.stream = stream if stream is not None else sys.stdout
+        self.bufsize = bufsize
+        self._parts = []
+        self._size = 0
+
+    def write(self, s: str) -> int:
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self.bufsize:
+            self.flush()
+        return len(s)
+
+    def flush(self) -> None:
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+        self.stream.flush()
+
+    def __enter__(self) -> 'TerminalWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.flush()
+
+
+class TerminalContext:
+    """Caches the terminal geometry instead of querying it on every call.
+    The cached size is invalidated on SIGWINCH when the handler can be
+    installed (main thread, attached to a TTY), otherwise it is refreshed
+    at most once every $ttl seconds. Non-TTYs always use the default.
+    Args:
+        default (int) = 80: Width used when the terminal size is unknown.
+        fd (Optional[int]): File descriptor to query, defaults to stdout.
+        ttl (float) = 1.0: Seconds before the cached size is re-queried
+            when no SIGWINCH handler is installed.
+    """
+
+    def __init__(
+        self,
+        default: int = 80,
+        fd: TYPE.Optional[int] = None,
+        ttl: float = 1.0,
+    ):
+        self.default = default
+        self.ttl = ttl
+        try:
+            self.fd = fd if fd is not None else sys.stdout.fileno()
+            self.isatty = os.isatty(self.fd)
+        except (AttributeError, ValueError, OSError):
+            self.fd, self.isatty = None, False
+
+        self._size = None
+        self._expires = 0.0
+        self._prev_handler = None
+        self.watching = False
+        if self.isatty:
+            self.watching = self._watch()
+
+    def _watch(self) -> bool:
+        """installs the SIGWINCH handler, chaining any previous handler"""
+        if not hasattr(signal, 'SIGWINCH'):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        try:
+            self._prev_handler = signal.signal(
+                signal.SIGWINCH, self._on_winch
+            )
+        except (ValueError, OSError):
+            return False
+        return True
+
+    def _on_winch(self, signum, frame) -> None:
+        self._size = None
+        if callable(self._prev_handler):
+            self._prev_handler(signum, frame)
+
+    def invalidate(self) -> None:
+        """Forces the next size lookup to query the terminal again"""
+        self._size = None
+
+    @property
+    def size(self) -> os.terminal_size:
+        """The (cached) terminal size as os.terminal_size"""
+        size = self._size
+        if size is not None:
+            if self.watching or not self.isatty:
+                return size
+            if time.monotonic() < self._expires:
+                return size
+
+        size = os.terminal_size((self.default, 24))
+        if self.isatty:
+            try:
+                size = os.get_terminal_size(self.fd)
+            except OSError:
+                pass
+            self._expires = time.monotonic() + self.ttl
+        self._size = size
+        return size
+
+    @property
+    def width(self) -> int:
+        return self.size.columns
+
+    @property
+    def height(self) -> int:
+        return self.size.lines
+
+    def buffered(
+        self, stream: TYPE.Optional[TYPE.TextIO] = None, bufsize: int = 65536
+    ) -> TerminalWriter:
+        """Returns a TerminalWriter, use as a context manager to flush"""
+        return TerminalWriter(stream, bufsize)
+
+    def print_middle(self, obj: TYPE.Any, char: str = '=', **kwargs) -> str:
+        """print_middle() using the cached terminal width"""
+        return print_middle(obj, char, terminal_width=self.width, **kwargs)
+
+    def print_columns(
+        self, iterable: TYPE.Iterable[str], separator: str = "  ", **kwargs
+    ) -> TYPE.List[str]:
+        """print_columns() using the cached terminal width"""
+        return print_columns(
+            iterable, separator, terminal_width=self.width, **kwargs
+        )
+
+    def print_table(
+        self,
+        rows: TYPE.Iterable[TYPE.Union[TYPE.Dict, TYPE.Sequence]],
+        **kwargs
+    ) -> int:
+        """print_table() using the cached terminal width"""
+        return print_table(rows, terminal_width=self.width, **kwargs)
+
+    def close(self) -> None:
+        """Restores the SIGWINCH handler that was replaced, if any"""
+        if self.watching:
+            try:
+                signal.signal(signal.SIGWINCH, self._prev_handler)
+            except (ValueError, OSError, TypeError):
+                pass
+            self.watching = False
+
+
 def print_middle(
-    obj: TYPE.Any, char: str = '=', noprint: bool = False, *args, **kwargs
+    obj: TYPE.Any,
+    char: str = '=',
+    noprint: bool = False,
+    *args,
+    terminal_width: TYPE.Optional[int] = None,
+    **kwargs
 ) -> str:
     """prints object str in middle of line of $chars based on terminal width
     passes *args/**kwargs to print()
@@ -19,8 +190,9 @@ def print_middle(
         obj (Any): The object whose string representation needs to be printed.
         char (str): Char used for line default '='
         noprint (bool) = False: If True, don't print, just return str
+        terminal_width (Optional[int]): The terminal width to be used.
     """
-    terminal_width = get_terminal_width()
+    terminal_width = terminal_width or get_terminal_width()
     obj = str(obj)
 
     padding = (terminal_width - len(obj) - 2) // 2
@@ -37,12 +209,14 @@ def print_columns(
     iterable: TYPE.Iterable[str],
     separator: str = "  ",
     terminal_width: TYPE.Optional[int] = None,
+    file: TYPE.Optional[TYPE.TextIO] = None,
 ) -> TYPE.List[str]:
     """Print a list of objects in columns based on the terminal width.
     Args:
         iterable (Iterable): The iterable to be printed.
         separator (str) = "  ": The separator to be used between columns.
         terminal_width (Optional[int]): The terminal width to be used.
+        file (Optional[TextIO]): Passed to print(), e.g. a TerminalWriter.
     Returns:
         List[str]: The list of strings that were printed.
     """
@@ -60,13 +234,281 @@ def print_columns(
         curobj += separator
 
         if len(curline) + len(curobj) > termwidth:
-            print(curline)
+            print(curline, file=file)
             printed.append(curline)
             curline = ""
         else:
             curline += curobj
     if curline:
-        print(curline)
+        print(curline, file=file)
         printed.append(curline)
 
     return printed
+
+
+def _fit_widths(widths: TYPE.List[int], avail: int, min_width: int) -> None:
+    """shrinks the widest columns in place until the sum fits $avail"""
+    excess = sum(widths) - avail
+    if excess <= 0:
+        return
+    # find the k widest columns which, cut down to a common level no
+    # lower than the next width (or min_width), remove the excess
+    order = sorted(widths, reverse=True)
+    total = 0
+    for k in range(1, len(order) + 1):
+        total += order[k - 1]
+        floor = max(order[k] if k < len(order) else 0, min_width)
+        if total - k * floor >= excess or floor == min_width:
+            break
+    level, extra = divmod(total - min(excess, total - k * floor), k)
+    # spread the remainder like shrinking one char at a time would: the
+    # leftmost of the cut columns end one narrower
+    narrower = k - extra
+    for i, width in enumerate(widths):
+        if width > level:
+            widths[i] = level + (narrower <= 0)
+            narrower -= 1
+
+
+def print_table(
+    rows: TYPE.Iterable[TYPE.Union[TYPE.Dict, TYPE.Sequence]],
+    headers: TYPE.Optional[TYPE.Sequence[str]] = None,
+    sample_size: int = 100,
+    separator: str = "  ",
+    ellipsis: str = '...',
+    min_width: int = 4,
+    terminal_width: TYPE.Optional[int] = None,
+    file: TYPE.Optional[TYPE.TextIO] = None,
+) -> int:
+    """Print rows as a table, streaming them one line at a time. Column
+    widths are inferred from the first $sample_size rows only, later rows
+    are truncated with truncstr to fit, so the iterable is never fully
+    materialized.
+    Args:
+        rows (Iterable[Union[Dict, Sequence]]): dicts or tuples/lists.
+        headers (Optional[Sequence[str]]): Column headers, for dict rows
+            these also select the keys, defaults to the sampled keys.
+        sample_size (int) = 100: Number of rows used to size the columns.
+        separator (str) = "  ": The separator to be used between columns.
+        ellipsis (str) = '...': Used when truncating a cell.
+        min_width (int) = 4: Columns are never shrunk below this width.
+        terminal_width (Optional[int]): The terminal width to be used.
+        file (Optional[TextIO]): Passed to print(), e.g. a TerminalWriter.
+    Returns:
+        int: The number of rows printed, not counting the header.
+    """
+    termwidth = terminal_width or get_terminal_width()
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+    if not sample:
+        return 0
+
+    keys = None
+    if isinstance(sample[0], dict):
+        if headers is None:
+            headers = []
+            for row in sample:
+                headers.extend(k for k in row if k not in headers)
+        keys = list(headers)
+        ncols = len(keys)
+    else:
+        ncols = max(len(row) for row in sample)
+        if headers is not None:
+            ncols = max(ncols, len(headers))
+
+    def _cells(row) -> TYPE.List[str]:
+        if keys is not None:
+            vals = [row.get(k, '') for k in keys]
+        else:
+            vals = list(row) + [''] * (ncols - len(row))
+        return [str(v).replace('\n', ' ') for v in vals]
+
+    widths = [0] * ncols
+    if headers is not None:
+        for i, h in enumerate(headers):
+            widths[i] = len(str(h))
+    for row in sample:
+        for i, cell in enumerate(_cells(row)):
+            if len(cell) > widths[i]:
+                widths[i] = len(cell)
+    _fit_widths(widths, termwidth - len(separator) * (ncols - 1), min_width)
+
+    def _line(cells: TYPE.List[str]) -> str:
+        out = []
+        for cell, width in zip(cells, widths):
+            if len(cell) > width:
+                if width > len(ellipsis):
+                    cell = truncstr(cell, width - len(ellipsis), ellipsis)
+                else:
+                    cell = cell[:width]
+            out.append(cell + ' ' * (width - len(cell)))
+        return separator.join(out).rstrip()
+
+    if headers is not None:
+        print(_line([str(h) for h in headers]), file=file)
+        print(separator.join('-' * w for w in widths), file=file)
+
+    printed = 0
+    for row in chain(sample, rows):
+        print(_line(_cells(row)), file=file)
+        printed += 1
+    return printed
+
+
+# open Progress instances watched by the monitor thread
+_progress_active = weakref.WeakSet()
+_progress_lock = threading.Lock()
+_progress_monitor = None
+_MONITOR_TICK = 0.05
+
+
+def _progress_watch(progress: 'Progress') -> None:
+    global _progress_monitor
+    with _progress_lock:
+        _progress_active.add(progress)
+        if _progress_monitor is None:
+            _progress_monitor = threading.Thread(
+                target=_progress_monitor_loop, name='Progress', daemon=True
+            )
+            _progress_monitor.start()
+
+
+def _progress_monitor_loop() -> None:
+    """Forces a clock check on every Progress whose redraw is due, so the
+    adaptive update step can't leave the line stale when a fast loop
+    slows down. Exits once no Progress is open."""
+    global _progress_monitor
+    while True:
+        time.sleep(_MONITOR_TICK)
+        now = time.monotonic()
+        with _progress_lock:
+            if not _progress_active:
+                _progress_monitor = None
+                return
+            active = list(_progress_active)
+        for progress in active:
+            if now >= progress._next_draw:
+                progress._next_check = 0
+
+
+class Progress:
+    """Single line progress/status reporter. update() is cheap enough for
+    tight loops: the clock is only read every $n updates, with $n adapted
+    to the observed update rate, and the line is redrawn at most
+    $max_rate times per second. A shared monitor thread forces a clock
+    read once a redraw is due, so a loop slowing down after a burst is
+    still redrawn on time. When $stream is not a TTY, a log line is
+    emitted every $log_interval seconds instead.
+    Args:
+        total (Optional[int]): Expected count, enables percentage and ETA.
+        desc (str) = '': Prefix for the status line.
+        max_rate (float) = 10.0: Maximum redraws per second.
+        stream (Optional[TextIO]): Defaults to sys.stderr.
+        logger (Optional[Logger]): Used when not a TTY, default get_logger().
+        log_interval (float) = 10.0: Seconds between non TTY log lines.
+        terminal_width (Optional[int]): The terminal width to be used.
+    """
+
+    def __init__(
+        self,
+        total: TYPE.Optional[int] = None,
+        desc: str = '',
+        max_rate: float = 10.0,
+        stream: TYPE.Optional[TYPE.TextIO] = None,
+        logger: TYPE.Optional[TYPE.Any] = None,
+        log_interval: float = 10.0,
+        terminal_width: TYPE.Optional[int] = None,
+    ):
+        self.total = total
+        self.desc = desc
+        self.stream = stream if stream is not None else sys.stderr
+        try:
+            self.isatty = self.stream.isatty()
+        except (AttributeError, ValueError):
+            self.isatty = False
+        self.interval = 1.0 / max_rate if self.isatty else log_interval
+        self.logger = logger
+        self.terminal_width = terminal_width
+
+        self.count = 0
+        self.start = time.monotonic()
+        self._next_check = 1
+        self._next_draw = self.start + self.interval
+        self._last_check = (self.start, 0)
+        self.closed = False
+        _progress_watch(self)
+
+    def update(self, n: int = 1) -> None:
+        """Adds $n to the count, redrawing if the interval has passed"""
+        self.count += n
+        if self.count >= self._next_check:
+            self._check()
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        last_time, last_count = self._last_check
+        if now > last_time:
+            per_sec = (self.count - last_count) / (now - last_time)
+            # aim for a few clock reads per redraw interval
+            step = int(per_sec * self.interval / 4)
+        else:
+            step = (self.count - last_count) * 2
+        self._next_check = self.count + max(1, step)
+        self._last_check = (now, self.count)
+
+        if now >= self._next_draw:
+            self._next_draw = now + self.interval
+            self.render(now)
+
+    def status(self, now: TYPE.Optional[float] = None) -> str:
+        """Returns the current status line text"""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+
+        parts = [self.desc + ':'] if self.desc else []
+        if self.total:
+            parts.append(
+                '%d/%d (%.1f%%)'
+                % (self.count, self.total, self.count * 100.0 / self.total)
+            )
+        else:
+            parts.append(str(self.count))
+        parts.append('%.1f/s' % rate)
+        parts.append('elapsed %s' % htime(int(elapsed * 1000)))
+        if self.total and rate > 0 and self.count < self.total:
+            eta = (self.total - self.count) / rate
+            parts.append('eta %s' % htime(int(eta * 1000)))
+        return ' '.join(parts)
+
+    def render(self, now: TYPE.Optional[float] = None) -> None:
+        """Draws the status line, or logs it when not attached to a TTY"""
+        line = self.status(now)
+        if self.isatty:
+            width = self.terminal_width or get_terminal_width()
+            if len(line) >= width:
+                line = truncstr(line, max(width - 4, 0), '...')
+            self.stream.write('\r' + line + '\x1b[K')
+            self.stream.flush()
+        else:
+            if self.logger is None:
+                self.logger = get_logger()
+            self.logger.info(line)
+
+    def close(self) -> None:
+        """Draws the final status and ends the line"""
+        if self.closed:
+            return
+        self.closed = True
+        with _progress_lock:
+            _progress_active.discard(self)
+        self.render()
+        if self.isatty:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def __enter__(self) -> 'Progress':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()